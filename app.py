@@ -2,24 +2,32 @@
 ZendureSimulator - A Python Plotly Dash application for simulating Zendure power distribution.
 """
 
+import json
+import logging
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
 import dash
 from dash import dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
-import plotly.graph_objs as go
-import pandas as pd
-from datetime import datetime, timedelta
 from simulator import ZendureSimulator
+from transport import EPOCH, compact, encode
 
 # Initialize the Dash app with Bootstrap theme
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = "Zendure Power Distribution"
 sim = ZendureSimulator()
+EXPORT_DIR = 'export'
+GRAPH_POINTS = 2000
+_LOGGER = logging.getLogger(__name__)
 
 # Create the layout
 app.layout = dbc.Container([
     # Header
     dbc.Row([
-        dcc.Upload(id='upload-data', accept='.log', children=
+        dcc.Upload(id='upload-data', accept='.log,.csv,.parquet', children=
         html.Div(
             [
                 dbc.Button('Zendure Power Distribution Simulator', color="danger", className="me-1", size="lg"),
@@ -35,6 +43,20 @@ app.layout = dbc.Container([
         dbc.Col(dbc.Label("Power tolerance (W):", className="m-1"), width="auto"),
         dbc.Col(dbc.Input(type="number", min=0, max=50, step=1, value=10, id='power_tolerance'), width="auto"),
         dbc.Col(dbc.Button("Start", id='start_button', color="primary"), width="auto"),
+        dbc.Col(dbc.Button("Export", id='export_button', color="secondary"), width="auto"),
+        dbc.Col(html.Span(id='export_status', className="m-1"), width="auto"),
+    ]),
+    dbc.Row([
+        dbc.Col(dbc.Label("Compare with:", className="m-1"), width="auto"),
+        dbc.Col(dcc.Dropdown(id='compare_run', options=[], value=None, placeholder='Previous run')),
+        dbc.Col(dbc.RadioItems(id='compare_mode', options=['Overlay', 'Diff'], value='Overlay', inline=True, className="m-1"), width="auto"),
+        dbc.Col(html.Span(id='energy_kpi', className="m-1"), width="auto"),
+    ]),
+    dbc.Row([
+        dbc.Col(dbc.Label("Fuse groups (JSON):", className="m-1"), width="auto"),
+        dbc.Col(dcc.Textarea(id='fuse_groups', value='', style={'width': '100%', 'height': 60},
+                             placeholder='[{"name": "house", "maxpower": 3600, "children": [{"name": "L1", "maxpower": 2400, "devices": ["<deviceId>"]}]}]')),
+        dbc.Col(html.Span(id='fuse_groups_status', className="m-1 text-danger"), width="auto"),
     ]),
 
     # Graphs
@@ -62,8 +84,10 @@ app.layout = dbc.Container([
     
     # Data storage and interval
     dcc.Store(id='simulation-data', data={
-        'time': [],
-    })
+        'version': 0,
+    }),
+    dcc.Store(id='figure-data'),
+    dcc.Store(id='graph-window'),
     
 ], fluid=True, className="p-2")
 
@@ -91,28 +115,174 @@ def load_logfile(upload_contents, data, filename):
     return data
 
 @app.callback(
-    Output('simulation-data', 'data', allow_duplicate=True),
+    [Output('simulation-data', 'data', allow_duplicate=True),
+     Output('fuse_groups_status', 'children')],
     Input('start_button', 'n_clicks'),
     [State('simulation-data', 'data'),
      State('distribution_mode', 'value'),
      State('start_power', 'value'),
-     State('power_tolerance', 'value')],
+     State('power_tolerance', 'value'),
+     State('fuse_groups', 'value')],
     prevent_initial_call=True
 )
-def update_simulation(button, data, distribution_mode, start_power, power_tolerance):
+def update_simulation(button, data, distribution_mode, start_power, power_tolerance, fuse_groups):
     """Update simulation data based on user actions and time intervals."""
-    return sim.do_simulation(data, distribution_mode, start_power, power_tolerance)
+    try:
+        fusegroups = json.loads(fuse_groups) if fuse_groups else []
+        return sim.do_simulation(data, distribution_mode, start_power, power_tolerance, fusegroups), ''
+    except ValueError as e:
+        _LOGGER.error("Invalid fuse group configuration: %s", e)
+        return dash.no_update, f"Invalid fuse groups: {e}"
+
+@app.callback(
+    Output('export_status', 'children'),
+    Input('export_button', 'n_clicks'),
+    prevent_initial_call=True
+)
+def export_simulation(button):
+    """Append the last simulation run to the Parquet dataset."""
+    from export import export_run
+
+    try:
+        run_id = export_run(sim, EXPORT_DIR)
+    except Exception as e:
+        _LOGGER.error("Export failed: %s", e)
+        return f"Export failed: {e}"
+    return f"Exported run {run_id}" if run_id else "Nothing to export"
 
 @app.callback(
-    Output('power-graph', 'figure'),
+    Output('compare_run', 'options'),
     [Input('simulation-data', 'data')]
 )
-def update_power_graph(data):
-    """Update the power flow graph."""
+def update_compare_runs(data):
+    """List the previous runs of the loaded logfile."""
+    return [{'label': r.label, 'value': r.runid} for r in reversed(sim.history.runs.values()) if r is not sim.run]
+
+@app.callback(
+    Output('graph-window', 'data'),
+    [Input('power-graph', 'relayoutData'),
+     Input('charge-graph', 'relayoutData')],
+    prevent_initial_call=True
+)
+def update_graph_window(power_relayout, charge_relayout):
+    """Keep the zoomed time window (epoch seconds) of the graphs."""
+    relayout = dash.callback_context.triggered[0]['value'] or {}
+    if relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout:
+        bounds = [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout:
+        bounds = relayout['xaxis.range']
+    else:
+        return dash.no_update
+    return [(datetime.fromisoformat(b) - EPOCH).total_seconds() if isinstance(b, str) else b / 1000 for b in bounds]
+
+@app.callback(
+    Output('figure-data', 'data'),
+    [Input('simulation-data', 'data'),
+     Input('compare_run', 'value'),
+     Input('compare_mode', 'value'),
+     Input('graph-window', 'data')]
+)
+def update_figure_data(data, compare_run, compare_mode, window):
+    """Update the typed array payload of the graphs."""
+    return figure_payload(data.get('version', 0) if data else 0, compare_run, compare_mode, tuple(window) if window else None)
+
+@app.callback(
+    Output('energy_kpi', 'children'),
+    [Input('simulation-data', 'data'),
+     Input('graph-window', 'data')]
+)
+def update_energy_kpi(data, window):
+    """Show the grid import and export of the time window."""
+    if sim.rollup is None or len(sim.time) == 0:
+        return ''
+    start, end = graph_window(window) or (None, None)
+    text = []
+    for name, label in [('p1', 'P1'), ('sim_p1', 'Simulated P1')]:
+        if name in sim.rollup.values:
+            imported, exported = sim.rollup.energy(name, start, end)
+            text.append(f"{label}: import {imported / 1000:.2f} kWh, export {exported / 1000:.2f} kWh")
+    return ' | '.join(text)
+
+# The traces share the x axis, it is only sent once and added in the browser
+for graph in ['power', 'charge']:
+    app.clientside_callback(
+        """
+        function(payload) {
+            if (!payload) {
+                return window.dash_clientside.no_update;
+            }
+            const fig = payload['%s'];
+            return {data: fig.data.map(t => Object.assign({x: payload.x}, t)), layout: fig.layout};
+        }
+        """ % graph,
+        Output(f'{graph}-graph', 'figure'),
+        Input('figure-data', 'data'),
+    )
+
+def graph_window(window):
+    """Return the window if it overlaps the loaded logfile."""
+    if not window or sim.rollup is None or len(sim.rollup.epoch) == 0:
+        return None
+    start, end = window
+    return (start, end) if start < sim.rollup.epoch[-1] and end > sim.rollup.epoch[0] else None
+
+def graph_series(window):
+    """Return the x axis and a function returning a series at the graph resolution.
+
+    The rollup level is picked for the window, with one window of margin on
+    both sides, so panning does not show an empty graph.
+    """
+    start = end = None
+    points = GRAPH_POINTS
+    if (window := graph_window(window)) is not None:
+        span = window[1] - window[0]
+        start, end, points = window[0] - span, window[1] + span, 3 * GRAPH_POINTS
+
+    def series(name):
+        return np.rint(sim.rollup.window(name, start, end, points)['mean']).astype(np.int64)
+
+    if sim.rollup is None or len(sim.time) == 0:
+        return np.zeros(0), series
+    return sim.rollup.window('p1', start, end, points)['time'] * 1000, series
+
+@lru_cache(maxsize=4)
+def figure_payload(version, compare_run=None, compare_mode='Overlay', window=None):
+    """Return the graphs of a simulator version, with all series as typed arrays."""
+    other = sim.history.find(compare_run) if sim.run is not None and compare_run != sim.run.runid else None
+    x, series = graph_series(window)
+    return {
+        'version': version,
+        'x': encode(x),
+        'power': power_figure(version, series, other, compare_mode).to_plotly_json(),
+        'charge': charge_figure(version, series, other, compare_mode).to_plotly_json(),
+    }
+
+def compare_trace(go, current, other, compare_mode, name, color):
+    """Return the trace of a previous run, or the difference with it."""
+    if compare_mode == 'Diff':
+        return go.Scatter(
+            y=compact(np.subtract(current, other)),
+            mode='lines',
+            name=f'{name} difference',
+            line=dict(color=color, width=2),
+        )
+    return go.Scatter(
+        y=compact(other),
+        mode='lines',
+        name=name,
+        line=dict(color=color, width=2, dash='dot'),
+    )
+
+def power_figure(version, series, other=None, compare_mode='Overlay'):
+    """Create the power flow graph."""
+    import plotly.graph_objs as go
+
     if len(sim.time) == 0:
         # Empty graph
         fig = go.Figure()
-        fig.add_trace(go.Scatter(x=[], y=[], mode='lines', name='P1'))
+        fig.add_trace(go.Scatter(y=[], mode='lines', name='P1'))
         fig.update_layout(
             xaxis_title='Time (seconds)',
             yaxis_title='Power (W)',
@@ -125,40 +295,35 @@ def update_power_graph(data):
     
     # Add power flow trace
     fig.add_trace(go.Scatter(
-        x=sim.time,
-        y=sim.p1,
+        y=compact(series('p1')),
         mode='lines',
         name='P1',
         line=dict(color='purple', width=2),
     ))
     
     fig.add_trace(go.Scatter(
-        x=sim.time,
-        y=sim.homeC,
+        y=compact(series('homeC')),
         mode='lines',
         name='Home Consumption',
         line=dict(color='black', width=2),
     ))
     
     fig.add_trace(go.Scatter(
-        x=sim.time,
-        y=sim.homeZ,
+        y=compact(series('homeZ')),
         mode='lines',
         name='Home Zendure',
         line=dict(color='lightgray', width=2),
     ))
     
     fig.add_trace(go.Scatter(
-        x=sim.time,
-        y=sim.solar,
+        y=compact(series('solar')),
         mode='lines',
         name='Solar',
         line=dict(color='yellow', width=2),
     ))
     
     fig.add_trace(go.Scatter(
-        x=sim.time,
-        y=sim.offgrid,
+        y=compact(series('offgrid')),
         mode='lines',
         name='Offgrid',
         line=dict(color='red', width=2),
@@ -166,8 +331,7 @@ def update_power_graph(data):
 
     if len(sim.sim_p1) > 0:
         fig.add_trace(go.Scatter(
-            x=sim.time,
-            y=sim.sim_p1,
+            y=compact(series('sim_p1')),
             mode='lines',
             name='Simulated P1',
             line=dict(color='blue', width=2),
@@ -175,21 +339,27 @@ def update_power_graph(data):
     
     if len(sim.sim_home) > 0:
         fig.add_trace(go.Scatter(
-            x=sim.time,
-            y=sim.sim_home,
+            y=compact(series('sim_home')),
             mode='lines',
             name='Simulated Home',
             line=dict(color='brown', width=2),
         ))
+
+    if other is not None and len(sim.sim_p1) == len(other.sim_p1):
+        prefix = sim.rollup_run(other)
+        fig.add_trace(compare_trace(go, series('sim_p1'), series(f'{prefix}sim_p1'), compare_mode, f'Simulated P1 #{other.runid}', 'royalblue'))
+        fig.add_trace(compare_trace(go, series('sim_home'), series(f'{prefix}sim_home'), compare_mode, f'Simulated Home #{other.runid}', 'chocolate'))
     
     # Add zero line
     fig.add_hline(y=0, line_dash="dash", line_color="gray")
     
     fig.update_layout(
         xaxis_title='Time (seconds)',
+        xaxis_type='date',
         yaxis_title='Power (W)',
         template='plotly_white',
         hovermode='x unified',
+        uirevision=sim.filename,
         showlegend=True,
         legend=dict(
             orientation="h",
@@ -204,16 +374,14 @@ def update_power_graph(data):
     
     return fig
 
-@app.callback(
-    Output('charge-graph', 'figure'),
-    [Input('simulation-data', 'data')]
-)
-def update_charge_graph(data):
-    """Update the battery charge graph."""
+def charge_figure(version, series, other=None, compare_mode='Overlay'):
+    """Create the battery charge graph."""
+    import plotly.graph_objs as go
+
     if len(sim.time) == 0 or len(sim.devices) == 0:
         # Empty graph
         fig = go.Figure()
-        fig.add_trace(go.Scatter(x=[], y=[], mode='lines', name='Charge Level'))
+        fig.add_trace(go.Scatter(y=[], mode='lines', name='Charge Level'))
         fig.update_layout(
             xaxis_title='Time (seconds)',
             yaxis_title='Charge Level (%)',
@@ -230,8 +398,7 @@ def update_charge_graph(data):
     for device in devices:
         if len(device.levels) > 0:
             fig.add_trace(go.Scatter(
-                x=sim.time,
-                y=device.levels,
+                y=compact(series(f'level/{device.name}')),
                 mode='lines',
                 name=device.name,
                 line=dict(color='green', width=2),
@@ -241,14 +408,16 @@ def update_charge_graph(data):
 
         if len(device.sim_level) > 0:
             fig.add_trace(go.Scatter(
-                x=sim.time,
-                y=device.sim_level,
+                y=compact(series(f'sim_level/{device.name}')),
                 mode='lines',
                 name=f'{device.name} sim',
                 line=dict(color='green', width=2),
                 fill='tozeroy',
                 fillcolor='rgba(0, 255, 0, 0.1)'
             ))
+
+        if other is not None and len(device.sim_level) == len(other.sim_level.get(device.name, [])):
+            fig.add_trace(compare_trace(go, series(f'sim_level/{device.name}'), series(f'{sim.rollup_run(other)}sim_level/{device.name}'), compare_mode, f'{device.name} sim #{other.runid}', 'darkgreen'))
     
     # Add warning zone
     fig.add_hline(y=10, line_dash="dash", line_color="red", opacity=0.1, line_width=0)
@@ -256,10 +425,12 @@ def update_charge_graph(data):
     
     fig.update_layout(
         xaxis_title='Time (seconds)',
+        xaxis_type='date',
         yaxis_title='Charge Level (%)',
-        yaxis_range=[0, 100],
+        yaxis_range=[-100 if other is not None and compare_mode == 'Diff' else 0, 100],
         template='plotly_white',
         hovermode='x unified',
+        uirevision=sim.filename,
         showlegend=True
     )
     
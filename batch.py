@@ -0,0 +1,268 @@
+"""Batched simulation of multiple sites."""
+
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+import numpy as np
+
+from distribution import CONST_FIXED, CONST_HIGH, CONST_LOW, CONST_POWER_JUMP, CONST_POWER_JUMP_HIGH, CONST_POWER_START
+from const import SmartMode
+from rollup import tick_energy
+from simulator import ZendureSimulator
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ZendureBatch:
+    """Simulate K sites in one run.
+
+    The logs are aligned on the tick index and padded with their last value, the
+    state of all devices is kept in (site, device) arrays. Distribution.update is
+    replayed for all sites at once, the per-device loops run over the device rank
+    instead of over every device of every site. Only the default fuse group per
+    device is supported.
+
+    Every tick has a fixed numpy overhead of about 0.4 ms, independent of K. On
+    3000 tick logs with 1-3 devices a batch breaks even with separate runs at
+    about 24 sites and is twice as fast at 64 sites, simulate fewer sites
+    separately.
+    """
+
+    def __init__(self, sims: list[ZendureSimulator] | None = None) -> None:
+        """Initialize the batch."""
+        self.sims: list[ZendureSimulator] = sims if sims is not None else []
+
+    def load_logfile(self, filename: str, contents: str) -> ZendureSimulator:
+        """Load a logfile as a new site."""
+        sim = ZendureSimulator()
+        sim.load_logfile(filename, contents)
+        self.sims.append(sim)
+        return sim
+
+    def do_simulation(self, distribution_mode: str, start_power: int, power_tolerance: int) -> dict[str, Any]:
+        """Simulate all sites, store the results in the simulators and return the aggregates."""
+        sims = [s for s in self.sims if len(s.time) > 0]
+        if len(sims) == 0:
+            return {}
+
+        K = len(sims)
+        D = max(len(s.devices) for s in sims)
+        T = max(len(s.time) for s in sims)
+        length = np.array([len(s.time) for s in sims])
+        sites = np.arange(K)
+        base = sites[:, None] * D
+        last = np.iinfo(np.int64).max
+
+        def pad(arr: np.ndarray, v: list[float]) -> None:
+            """Copy a series padded with its last value."""
+            arr[: len(v)] = v
+            arr[len(v):] = v[-1] if len(v) > 0 else 0
+
+        def series(values: list[list[float]], dtype: Any) -> np.ndarray:
+            """Stack the series of all sites."""
+            arr = np.empty((T, K), dtype=dtype)
+            for k, v in enumerate(values):
+                pad(arr[:, k], v)
+            return arr
+
+        # input series
+        seconds = [[0.0] + [(b - a).total_seconds() for a, b in zip(s.time, s.time[1:])] for s in sims]
+        dt = series(seconds, np.float64)
+        p1 = series([s.p1 for s in sims], np.int64)
+        homeC = series([s.homeC for s in sims], np.int64)
+        exist = np.zeros((K, D), dtype=bool)
+        solar = np.zeros((T, K, D), dtype=np.int64)
+        offgrid = np.zeros((T, K, D), dtype=np.int64)
+
+        # device state
+        kWh = np.ones((K, D))
+        minSoc = np.zeros((K, D))
+        socSet = np.full((K, D), 100.0)
+        limit = np.zeros((2, K, D), dtype=np.int64)
+        level0 = np.zeros((K, D), dtype=np.int64)
+        home = np.zeros((K, D), dtype=np.int64)
+        pv = np.zeros((K, D), dtype=np.int64)
+        off = np.zeros((K, D), dtype=np.int64)
+        for k, s in enumerate(sims):
+            for j, d in enumerate(s.devices.values()):
+                exist[k, j] = True
+                pad(solar[:, k, j], d.solar)
+                pad(offgrid[:, k, j], d.offgrid)
+                kWh[k, j] = d.kWh
+                minSoc[k, j] = d.minSoc.asNumber
+                socSet[k, j] = d.socSet.asNumber
+                limit[:, k, j] = d.limit
+                level0[k, j] = d.levels[d.startindex]
+                home[k, j] = s.homeZ[d.startindex]
+                pv[k, j] = d.solar[d.startindex]
+                off[k, j] = d.offgrid[d.startindex]
+
+        avail = kWh * (level0 - minSoc) / 100
+        avail_max = kWh * (socSet - minSoc) / 100
+        level = np.round(100 * avail / avail_max).astype(np.int64)
+        setpoints = np.zeros((K, D), dtype=np.int64)
+        fuselimit = np.stack([np.maximum(-3200, limit[0]), np.minimum(3200, limit[1])])
+
+        # setpoint history as ring buffer, deque([0], maxlen=4)
+        history = np.zeros((K, 4), dtype=np.int64)
+        hcount = np.ones(K, dtype=np.int64)
+        hhead = np.ones(K, dtype=np.int64)
+
+        sim_p1 = np.zeros((T, K), dtype=np.int64)
+        sim_home = np.zeros((T, K), dtype=np.int64)
+        sim_level = np.zeros((T, K, D), dtype=np.int64)
+        sim_level[0] = level0
+
+        def distribute(mask: np.ndarray, c: int | slice, power: np.ndarray) -> np.ndarray:
+            """ZendureDevice.distribute for the devices of rank c of every site in mask."""
+            hp = rhome[:, c]
+            keep = np.abs(power - hp) <= SmartMode.POWER_TOLERANCE
+            pwr = np.minimum(np.maximum(rlimit0[:, c], power), rlimit1[:, c])
+            lvl = rlevel[:, c]
+            full = (pwr < 0) & (lvl >= 99)
+            empty = ~full & (lvl <= 1) & (roff[:, c] <= 0)
+            pwr = np.where(full, 0, np.where(empty, np.minimum(rpv[:, c], pwr), pwr))
+            np.copyto(rsetpoints[:, c], pwr, where=mask & ~keep)
+            return np.where(mask, np.where(keep, hp, pwr), 0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(T):
+                if i == 0:
+                    simp1 = p1[0].copy()
+                else:
+                    # update the totals and the running values
+                    pv = solar[i]
+                    off = offgrid[i]
+                    home = setpoints.copy()
+                    simhome = home.sum(axis=1)
+                    battery = home - pv + off
+                    avail = np.maximum(0, np.minimum(avail - (battery / 3600000) * dt[i][:, None], avail_max))
+                    level = np.round(100 * avail / avail_max).astype(np.int64)
+                    sim_level[i] = np.round(100 * avail / kWh + minSoc)
+                    simp1 = homeC[i] - simhome
+
+                # Distribution.get_setpoint
+                setpoint = simp1 + home.sum(axis=1)
+                solartotal = (pv + np.where(off < 0, -off, 0)).sum(axis=1)
+                solarOnly = (setpoint > 0) & (solartotal > setpoint)
+
+                # average and delta setpoint
+                avg = np.trunc(history.sum(axis=1) / hcount).astype(np.int64)
+                delta = avg - setpoint
+                jump = np.abs(delta) > CONST_POWER_JUMP
+                setpoint = np.where(jump & (delta > CONST_POWER_JUMP_HIGH), np.trunc(avg - 0.75 * delta).astype(np.int64), setpoint)
+                setpoint = np.where(setpoint * avg < 0, 0, setpoint)
+                history[jump] = 0
+                hcount[jump] = 0
+                hhead[jump] = 0
+                history[sites, hhead] = setpoint
+                hhead = (hhead + 1) % 4
+                hcount = np.minimum(hcount + 1, 4)
+
+                # order the devices, padded devices last, and take all state in that order
+                charge = ~solarOnly & (setpoint < 0)
+                bonus = np.where(home == 0, 0, 3)
+                key = np.where(charge[:, None], level - bonus, level + bonus)
+                key = np.where(solarOnly[:, None] | charge[:, None], key, -key)
+                order = np.argsort(np.where(exist, key, last), axis=1, kind="stable")
+                # take with flat indices, take_along_axis costs more than the gather itself on these small arrays
+                flat = order + base
+                rexist = exist.take(flat)
+                rhome = home.take(flat)
+                rlevel = level.take(flat)
+                rpv = pv.take(flat)
+                roff = off.take(flat)
+                rlimit0 = limit[0].take(flat)
+                rlimit1 = limit[1].take(flat)
+                rsetpoints = setpoints.take(flat)
+
+                # solar only, distribute the solar power
+                if solarOnly.any():
+                    sp = setpoint.copy()
+                    for r in range(D):
+                        sp -= distribute(solarOnly & rexist[:, r], r, np.minimum(sp, rpv[:, r]))
+
+                # Distribution.distrbute, the devices that are not used are set first
+                if not solarOnly.all():
+                    c = charge[:, None]
+                    lim = np.where(c, rlimit0, rlimit1)
+                    plim = np.where(c, fuselimit[0], fuselimit[1]).take(flat)
+                    ravail = avail.take(flat)
+                    rkWh = kWh.take(flat)
+                    weight = np.where(c, np.where(rlevel < 100, rkWh - ravail, 0.0), np.where(rlevel > 0, ravail, 0.0))
+                    startpower = np.where(charge, -CONST_POWER_START, CONST_POWER_START)
+                    start = setpoint.copy()
+                    power = np.zeros((K, D), dtype=np.int64)
+                    used = np.zeros((K, D), dtype=bool)
+                    nused = np.zeros(K, dtype=np.int64)
+                    totalpower = np.zeros(K, dtype=np.int64)
+                    totalweight = np.zeros(K)
+                    for r in range(D):
+                        mask = ~solarOnly & rexist[:, r]
+                        w = weight[:, r]
+                        dl = lim[:, r]
+                        nostart = w == 0.0
+                        idle = ~nostart & (rhome[:, r] == 0)
+                        startdevice = idle & (w > 0) & (start != 0)
+                        run = mask & ~nostart & ~idle & ((nused == 0) | (setpoint / (totalpower + dl) >= CONST_LOW))
+                        newstart = np.trunc(start - dl * CONST_HIGH).astype(np.int64)
+                        newstart = np.where(charge, np.minimum(0, newstart), np.maximum(0, newstart))
+                        start = np.where(mask & (startdevice | run), newstart, start)
+                        power[:, r] = np.where(startdevice, startpower, 0)
+                        used[:, r] = run
+                        nused += run
+                        totalpower += np.where(run, plim[:, r], 0)
+                        totalweight += np.where(run, w, 0.0)
+                    distribute(~solarOnly[:, None] & rexist & ~used, slice(None), power)
+
+                    active = ~solarOnly & (totalpower != 0) & (totalweight != 0.0)
+                    fixedpct = np.minimum(CONST_FIXED, np.abs(setpoint / totalpower))
+                    sp = setpoint.copy()
+                    for r in range(D):
+                        mask = active & used[:, r]
+                        dl = lim[:, r]
+                        flexible = np.where(fixedpct < CONST_FIXED, 0, sp - CONST_FIXED * totalpower)
+                        totalpower = np.where(mask, totalpower - plim[:, r], totalpower)
+                        w = weight[:, r]
+                        pwr = np.where(
+                            totalweight == 0, 0, np.where(totalpower != 0, np.trunc(fixedpct * dl + flexible * (w / totalweight)), sp)
+                        ).astype(np.int64)
+                        rest = sp - totalpower
+                        pwr = np.where(charge, np.maximum(dl, np.minimum(pwr, rest)), np.minimum(dl, np.maximum(pwr, rest)))
+                        sp -= distribute(mask, r, pwr)
+                        totalweight = np.where(mask, np.round(totalweight - w, 2), totalweight)
+
+                setpoints.put(flat, rsetpoints)
+                sim_p1[i] = simp1
+                sim_home[i] = setpoints.sum(axis=1)
+
+        # store the per site results like ZendureSimulator.do_simulation
+        for k, s in enumerate(sims):
+            n = length[k]
+            s.parameters = s.run_parameters(distribution_mode, start_power, power_tolerance)
+            s.run = None
+            s.sim_p1 = [s.p1[0]] + sim_p1[:n, k].tolist()
+            s.sim_home = [s.homeZ[0]] + sim_home[:n, k].tolist()
+            for j, d in enumerate(s.devices.values()):
+                d.sim_level = sim_level[:n, k, j].tolist()
+            s.version += 1
+
+        # the value of a tick is held until the next tick
+        hold = series([x[1:] + [0.0] for x in seconds], np.float64)
+        return self.aggregates(sim_p1, hold, length)
+
+    @staticmethod
+    def aggregates(sim_p1: np.ndarray, hold: np.ndarray, length: np.ndarray) -> dict[str, Any]:
+        """Return the grid energy per site and for the whole fleet, hold is the time to the next tick."""
+        live = np.arange(sim_p1.shape[0])[:, None] < length[None, :]
+        imported, exported = tick_energy(np.where(live, sim_p1, 0), hold)
+        imported, exported = imported / 3600000, exported / 3600000
+        return {
+            "import_kwh": imported.tolist(),
+            "export_kwh": exported.tolist(),
+            "fleet_import_kwh": float(imported.sum()),
+            "fleet_export_kwh": float(exported.sum()),
+            "fleet_p1": np.where(live, sim_p1, 0).sum(axis=1).tolist(),
+        }
@@ -128,7 +128,7 @@ class Distribution:
                 continue
             setpoint += d.homePower.asInt
             solar += d.solarPower.asInt
-            d.fuseGrp.initPower = True
+            d.fuseUpdate()
             if d.offGrid is not None:
                 if (off_grid := d.offGrid.asInt) < 0:
                     solar += -off_grid
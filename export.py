@@ -0,0 +1,117 @@
+"""Export simulation runs to a partitioned Parquet dataset."""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import uuid
+from urllib.parse import quote
+from datetime import datetime
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from simulator import ZendureSimulator
+
+_LOGGER = logging.getLogger(__name__)
+
+ROW_GROUP_SIZE = 100_000
+
+
+def _partition(path: str, table: str, mode: str, day: str) -> str:
+    """Return the hive style partition directory."""
+    directory = os.path.join(path, table, f"distribution_mode={quote(mode)}", f"date={day}")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def export_run(sim: ZendureSimulator, path: str, row_group_size: int = ROW_GROUP_SIZE) -> str:
+    """Append the last run of the simulator to the dataset and return the run id.
+
+    The dataset has two tables: series with one row per tick, and levels with one
+    row per tick and device. The run parameters are stored as columns, the fuse
+    groups as a JSON string, the distribution mode and the date of the log are
+    the partitions. Every run is
+    written as a new file in row groups, so memory stays bounded.
+    """
+    count = len(sim.time)
+    if count == 0:
+        return ""
+    if not sim.parameters:
+        raise ValueError("The parameters of the last run are unknown, simulate the log first")
+
+    run_id = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    mode = sim.parameters.get("distribution_mode", "")
+    day = f"{sim.time[0]:%Y-%m-%d}"
+    params = {
+        "run_id": run_id,
+        "logfile": os.path.basename(sim.filename),
+        "start_power": sim.parameters.get("start_power", 0),
+        "power_tolerance": sim.parameters.get("power_tolerance", 0),
+        "fusegroups": json.dumps(sim.parameters.get("fusegroups") or [], sort_keys=True, separators=(",", ":")),
+    }
+
+    # sim_p1 and sim_home start with the initial value twice
+    sim_p1 = sim.sim_p1[-count:] if len(sim.sim_p1) >= count else [None] * count
+    sim_home = sim.sim_home[-count:] if len(sim.sim_home) >= count else [None] * count
+    devices = list(sim.devices.values())
+    sim_levels = [d.sim_level[-count:] if len(d.sim_level) >= count else [None] * count for d in devices]
+
+    def columns(df: pd.DataFrame) -> pd.DataFrame:
+        for key, value in params.items():
+            df[key] = value
+        return df
+
+    series_file = os.path.join(_partition(path, "series", mode, day), f"{run_id}.parquet")
+    levels_file = os.path.join(_partition(path, "levels", mode, day), f"{run_id}.parquet")
+    series_writer: pq.ParquetWriter | None = None
+    levels_writer: pq.ParquetWriter | None = None
+    try:
+        for start in range(0, count, row_group_size):
+            end = min(count, start + row_group_size)
+            series = columns(pd.DataFrame({
+                "time": pd.to_datetime(sim.time[start:end]),
+                "p1": sim.p1[start:end],
+                "homeC": sim.homeC[start:end],
+                "homeZ": sim.homeZ[start:end],
+                "solar": sim.solar[start:end],
+                "offgrid": sim.offgrid[start:end],
+                "sim_p1": pd.array(sim_p1[start:end], dtype="Int32"),
+                "sim_home": pd.array(sim_home[start:end], dtype="Int32"),
+            }))
+            levels = columns(pd.concat([pd.DataFrame({
+                "time": series["time"],
+                "device": d.name,
+                "level": d.levels[start:end],
+                "sim_level": pd.array(sim_level[start:end], dtype="Int16"),
+            }) for d, sim_level in zip(devices, sim_levels)], ignore_index=True)) if devices else None
+
+            table = pa.Table.from_pandas(series, preserve_index=False)
+            if series_writer is None:
+                series_writer = pq.ParquetWriter(series_file, table.schema)
+            series_writer.write_table(table)
+            if levels is not None:
+                table = pa.Table.from_pandas(levels, preserve_index=False)
+                if levels_writer is None:
+                    levels_writer = pq.ParquetWriter(levels_file, table.schema)
+                levels_writer.write_table(table)
+    finally:
+        if series_writer is not None:
+            series_writer.close()
+        if levels_writer is not None:
+            levels_writer.close()
+
+    _LOGGER.info("Exported run %s to %s", run_id, path)
+    return run_id
+
+
+def read_runs(path: str, table: str = "series", columns: list[str] | None = None, **filters: Any) -> pd.DataFrame:
+    """Read a table of the dataset, only the partitions and row groups matching the filters are loaded."""
+    return pd.read_parquet(
+        os.path.join(path, table),
+        columns=columns,
+        filters=[(key, "==", value) for key, value in filters.items()] or None,
+    )
@@ -3,6 +3,8 @@
 from __future__ import annotations
 
 import logging
+import math
+from typing import Any
 
 from simDevice import ZendureDevice
 
@@ -10,41 +12,177 @@ _LOGGER = logging.getLogger(__name__)
 
 
 class FuseGroup:
-    """Zendure Fuse Group."""
+    """Zendure Fuse Group.
 
-    def __init__(self, name: str, maxpower: int, minpower: int, devices: list[ZendureDevice] | None = None) -> None:
+    Fuse groups form a tree (breaker -> phase -> house connection). Each group
+    caches the aggregate limit and weight of its active devices and child groups,
+    these are only recomputed along the path of a group marked dirty.
+    """
+
+    def __init__(self, name: str, maxpower: int, minpower: int, devices: list[ZendureDevice] | None = None, parent: FuseGroup | None = None) -> None:
         """Initialize the fuse group."""
         self.name: str = name
         self.limit = [minpower, maxpower]
-        self.initPower = True
-        self.devices: list[ZendureDevice] = devices if devices is not None else []
-        for d in self.devices:
-            d.fuseGrp = self
+        self.parent: FuseGroup | None = None
+        self.children: list[FuseGroup] = []
+        self.devices: list[ZendureDevice] = []
+        self.dirty = True
+        self.total = [0, 0]
+        self.weight = [0, 0]
+        self.budget: list[int | None] = [None, None]
+        for d in devices if devices is not None else []:
+            self.add_device(d)
+        if parent is not None:
+            parent.add_child(self)
 
-    def devicelimit(self, d: ZendureDevice, idx: int) -> int:
-        """Return the limit discharge power for a device."""
-        if self.initPower:
-            self.initPower = False
+    def add_device(self, d: ZendureDevice) -> None:
+        """Add a device to the fuse group."""
+        if (old := d.__dict__.get("fuseGrp")) is not None and d in old.devices:
+            old.devices.remove(d)
+            old.mark_dirty()
+        d.fuseGrp = self
+        d.fuseKey = None
+        self.devices.append(d)
+        self.mark_dirty()
+
+    def add_child(self, group: FuseGroup) -> None:
+        """Add a child fuse group."""
+        if group.parent is not None:
+            group.parent.children.remove(group)
+            group.parent.mark_dirty()
+        group.parent = self
+        self.children.append(group)
+        self.mark_dirty()
+
+    def mark_dirty(self) -> None:
+        """Invalidate the cached aggregates of this group and its ancestors."""
+        grp: FuseGroup | None = self
+        while grp is not None and not grp.dirty:
+            grp.dirty = True
+            grp = grp.parent
+        # the allocation of all ancestors must be refreshed as well
+        grp = self
+        while grp is not None and grp.budget != [None, None]:
+            grp.budget = [None, None]
+            grp = grp.parent
+
+    @property
+    def root(self) -> FuseGroup:
+        grp = self
+        while grp.parent is not None:
+            grp = grp.parent
+        return grp
+
+    def aggregate(self) -> None:
+        """Recompute the cached totals of the dirty part of the tree."""
+        if not self.dirty:
+            return
+        self.dirty = False
+        for idx in (0, 1):
             lim = max if idx == 0 else min
-            if len(self.devices) == 1:
-                d.power_limit = lim(self.limit[idx], d.limit[idx])
+            limit = 0
+            weight = 0
+            for fd in self.devices:
+                if fd.homePower.asInt != 0:
+                    limit += fd.limit[idx]
+                    weight += (100 - fd.level) * fd.limit[idx]
+            for child in self.children:
+                child.aggregate()
+                limit += child.total[idx]
+                weight += child.weight[idx]
+            self.total[idx] = lim(self.limit[idx], limit)
+            self.weight[idx] = weight
+
+    def allocate(self, idx: int, budget: int) -> None:
+        """Divide the budget over the active devices and child groups."""
+        if self.budget[idx] == budget:
+            return
+        self.budget[idx] = budget
+        lim = max if idx == 0 else min
+        if len(self.devices) == 1 and len(self.children) == 0:
+            d = self.devices[0]
+            d.fuse_limit[idx] = lim(budget, d.limit[idx])
+            return
+
+        members: list[tuple[ZendureDevice | FuseGroup, int, int]] = [
+            (fd, fd.limit[idx], (100 - fd.level) * fd.limit[idx]) for fd in self.devices if fd.homePower.asInt != 0
+        ]
+        members.extend((c, c.total[idx], c.weight[idx]) for c in self.children if c.total[idx] != 0)
+        limit = sum(m[1] for m in members)
+        weight = sum(m[2] for m in members)
+        avail = lim(budget, limit)
+        for m, mlimit, mweight in members:
+            power_limit = int(avail * mweight / weight) if weight < 0 else mlimit
+            limit -= mlimit
+            if limit > avail - power_limit:
+                power_limit = lim(avail - limit, avail)
+            power_limit = lim(power_limit, mlimit)
+            avail -= power_limit
+            if isinstance(m, FuseGroup):
+                m.allocate(idx, power_limit)
             else:
-                limit = 0
-                weight = 0
-                for fd in self.devices:
-                    if fd.homePower.asInt != 0:
-                        limit += fd.limit[idx]
-                        weight += (100 - fd.level) * fd.limit[idx]
-                avail = lim(self.limit[idx], limit)
-                for fd in self.devices:
-                    if fd.homePower.asInt != 0:
-                        fd.power_limit = int(avail * ((100 - fd.level) * fd.limit[idx]) / weight) if weight < 0 else fd.limit[idx]
-                        limit -= fd.limit[idx]
-                        if limit > avail - fd.power_limit:
-                            fd.power_limit = lim(avail - limit, avail)
-                        fd.power_limit = lim(fd.power_limit, fd.limit[idx])
-                        avail -= fd.power_limit
-        return d.power_limit
+                m.fuse_limit[idx] = power_limit
+
+    def devicelimit(self, d: ZendureDevice, idx: int) -> int:
+        """Return the limit discharge power for a device."""
+        root = self.root
+        if root.budget[idx] is None:
+            root.aggregate()
+            root.allocate(idx, root.limit[idx])
+        return d.fuse_limit[idx]
+
+
+def check_fusegroups(config: Any) -> None:
+    """Raise a ValueError if the configuration is not a list of fuse groups."""
+
+    def check(cfg: Any, path: str) -> None:
+        if not isinstance(cfg, dict):
+            raise ValueError(f"{path} is not an object")
+        if not isinstance(cfg.get("name", ""), str):
+            raise ValueError(f"{path}: name is not a string")
+        for key in ("maxpower", "minpower"):
+            if key in cfg and (isinstance(value := cfg[key], bool) or not isinstance(value, (int, float)) or not math.isfinite(value)):
+                raise ValueError(f"{path}: {key} is not a number")
+        if not isinstance(devices := cfg.get("devices", []), list) or not all(isinstance(d, str) for d in devices):
+            raise ValueError(f"{path}: devices is not a list of device ids")
+        if not isinstance(children := cfg.get("children", []), list):
+            raise ValueError(f"{path}: children is not a list")
+        for i, child in enumerate(children):
+            check(child, f"{path}.children[{i}]")
+
+    if not isinstance(config, list):
+        raise ValueError("Fuse groups must be a list of groups")
+    for i, cfg in enumerate(config):
+        check(cfg, f"Fuse group [{i}]")
+
+
+def load_fusegroups(config: list[dict[str, Any]], devices: dict[str, ZendureDevice]) -> list[FuseGroup]:
+    """Build the fuse group tree from a configuration.
+
+    Every group is a dict with a name, maxpower, minpower and optionally a list of
+    device ids and child groups. Devices not mentioned keep their own group. An
+    invalid configuration raises a ValueError before any group is changed.
+    """
+    check_fusegroups(config)
+    groups: list[FuseGroup] = []
+
+    def build(cfg: dict[str, Any], parent: FuseGroup | None) -> None:
+        maxpower = int(cfg.get("maxpower", 3200))
+        grp = FuseGroup(cfg.get("name", ""), maxpower, int(cfg.get("minpower", -maxpower)), parent=parent)
+        groups.append(grp)
+        for deviceid in cfg.get("devices", []):
+            if (d := devices.get(deviceid)) is None:
+                _LOGGER.warning("Fuse group %s: unknown device %s", grp.name, deviceid)
+                continue
+            grp.add_device(d)
+        for child in cfg.get("children", []):
+            build(child, grp)
+
+    for d in devices.values():
+        FuseGroup(d.name, 3200, -3200, devices=[d])
+    for cfg in config:
+        build(cfg, None)
+    return groups
 
 
 CONST_EMPTY_GROUP = FuseGroup("empty", 0, 0)
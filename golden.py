@@ -0,0 +1,238 @@
+"""
+Golden replay check: compare the simulator output of a corpus of logs with stored results.
+
+The corpus consists of the recorded logs in golden/corpus (*.log) and a set of
+synthetic logs, one of them with devices sharing a fuse group. For every log the input series and the simulated series must
+match the golden results within the tolerance, and the wall time and peak
+memory may not exceed the golden baseline by more than the budget. The
+lockstep simulation of a set of variants that diverge must match separate
+runs of every variant, a replay over the message bus must match
+do_simulation and a batch of all logs must match separate runs of every log.
+
+    python golden.py            check all logs
+    python golden.py --update   store new golden results
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any
+
+from batch import ZendureBatch
+from lockstep import VariantDistribution, ZendureLockstep
+from replay import replay
+from simulator import ZendureSimulator
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+SYNTHETIC = {"synthetic-1": (1, 3000, 1), "synthetic-2": (2, 3000, 2), "synthetic-3": (3, 3000, 3), "synthetic-shared": (3, 3000, 3)}
+FUSEGROUPS = {"synthetic-shared": [{"name": "L1", "maxpower": 900, "devices": ["dev0", "dev1"]}]}
+PARAMETERS = [("Neutral", 50, 10), ("Max Solar", 50, 10)]
+VARIANTS = [("Neutral", 50, 5), ("Neutral", 50, 10), ("Neutral", 80, 20), ("Max Solar", 50, 10), ("Max Solar", 50, 20)]
+
+
+class ToleranceStart(VariantDistribution):
+    """Distribution that starts a device with ten times the power tolerance, so the lockstep variants diverge."""
+
+    def distrbute(self, *args: Any) -> None:
+        self.start = [-10 * self.power_tolerance, 10 * self.power_tolerance]
+        super().distrbute(*args)
+
+
+def synthetic_log(seed: int, ticks: int, devices: int) -> str:
+    """Generate a deterministic logfile with P1 updates and device reports."""
+    rnd = random.Random(seed)
+    t = datetime(2025, 6, 1, 8, 0, 0)
+    lines = []
+    for i in range(ticks):
+        t += timedelta(seconds=rnd.choice([1, 2, 3]), milliseconds=rnd.randint(0, 999))
+        ts = t.strftime("%Y-%m-%d %H:%M:%S.%f")[:23]
+        if i % 5 == 0:
+            for k in range(devices):
+                props = {
+                    "gridInputPower": 0,
+                    "outputHomePower": rnd.randint(0, 800),
+                    "solarInputPower": int(600 * abs(math.sin(i / 500 + k))),
+                    "electricLevel": 40 + 10 * k,
+                    "gridOffPower": 0,
+                    "inverseMaxPower": 800,
+                    "chargeLimit": 1000,
+                }
+                packs = [{"sn": f"C0F{k}X{j}", "socLevel": 40 + 10 * k + j, "power": rnd.randint(-300, 300)} for j in range(2)]
+                lines.append(f"{ts} DEBUG [zendure] /73bkTV/dev{k}/properties/report => {{'deviceId': 'dev{k}', 'properties': {props}, 'packData': {packs}}}")
+        if i == 3:
+            lines.append(f"{ts} INFO [zendure] Update operation: 2 ")
+        lines.append(f"{ts} DEBUG [zendure] P1 ======> p1:{rnd.randint(-500, 900)} W")
+    return "\n".join(lines)
+
+
+def corpus() -> dict[str, bytes]:
+    """Return all logs of the corpus."""
+    logs = {name: synthetic_log(*args).encode() for name, args in SYNTHETIC.items()}
+    for path in sorted(glob.glob(os.path.join(GOLDEN_DIR, "corpus", "*.log"))):
+        with open(path, "rb") as f:
+            logs[os.path.basename(path)[:-4]] = f.read()
+    return logs
+
+
+def run(contents: bytes, fusegroups: list[dict[str, Any]] | None = None) -> dict[str, list]:
+    """Load and simulate a log with all parameter sets."""
+    sim = ZendureSimulator()
+    sim.load_log("golden.log", contents)
+    result: dict[str, list] = {
+        "p1": sim.p1,
+        "homeC": sim.homeC,
+        "homeZ": sim.homeZ,
+        "solar": sim.solar,
+        "offgrid": sim.offgrid,
+    }
+    for mode, start_power, power_tolerance in PARAMETERS:
+        sim.do_simulation({}, mode, start_power, power_tolerance, fusegroups)
+        key = f"{mode}/{start_power}/{power_tolerance}"
+        result[f"{key}/sim_p1"] = sim.sim_p1
+        result[f"{key}/sim_home"] = sim.sim_home
+        for d in sim.devices.values():
+            result[f"{key}/{d.name}/sim_level"] = d.sim_level
+    return result
+
+
+def outputs(sim: ZendureSimulator) -> dict[str, list]:
+    """Return the simulated series of a simulator."""
+    return {"sim_p1": sim.sim_p1, "sim_home": sim.sim_home, **{f"{d.name}/sim_level": d.sim_level for d in sim.devices.values()}}
+
+
+def lockstep(contents: bytes, fusegroups: list[dict[str, Any]] | None = None) -> list[str]:
+    """Return the differences between forked lockstep runs and separate runs of the variants."""
+    sim = ZendureSimulator()
+    sim.load_log("golden.log", contents)
+    lockstep = ZendureLockstep(sim, ToleranceStart)
+    report = lockstep.run(VARIANTS, fusegroups)
+    errors = [] if report.get("forks") else ["lockstep: no variant forked"]
+    for variant, run in zip(VARIANTS, lockstep.runs):
+        sim.start_simulation(*variant, fusegroups, factory=ToleranceStart)
+        sim.continue_simulation()
+        expected = outputs(sim)
+        actual = {"sim_p1": list(run.sim_p1), "sim_home": list(run.sim_home), **{f"{name}/sim_level": list(v) for name, v in run.sim_level.items()}}
+        errors.extend(f"lockstep {'/'.join(map(str, variant))} {error}" for error in compare(expected, actual, 0))
+    return errors
+
+
+def replayed(contents: bytes, fusegroups: list[dict[str, Any]] | None = None) -> list[str]:
+    """Return the differences between a replay over the message bus as fast as possible and do_simulation."""
+    mode, start_power, power_tolerance = PARAMETERS[0]
+    sim = ZendureSimulator()
+    sim.load_log("golden.log", contents)
+    sim.do_simulation({}, mode, start_power, power_tolerance, fusegroups)
+    expected = outputs(sim)
+    replay(sim, mode, start_power, power_tolerance, 0, fusegroups)
+    actual = outputs(sim)
+    return [f"replay {error}" for error in compare(expected, actual, 0)]
+
+
+def batched(logs: dict[str, bytes]) -> list[str]:
+    """Return the differences between a batch of all logs and separate runs, the batch only supports the default fuse groups."""
+    sims = {}
+    for name, contents in logs.items():
+        sims[name] = ZendureSimulator()
+        sims[name].load_log("golden.log", contents)
+    batch = ZendureBatch(list(sims.values()))
+    errors = []
+    for mode, start_power, power_tolerance in PARAMETERS:
+        batch.do_simulation(mode, start_power, power_tolerance)
+        for name, sim in sims.items():
+            actual = outputs(sim)
+            sim.do_simulation({}, mode, start_power, power_tolerance)
+            errors.extend(f"batch {name} {mode}/{start_power}/{power_tolerance} {error}" for error in compare(outputs(sim), actual, 0))
+    return errors
+
+
+def measure(contents: bytes, fusegroups: list[dict[str, Any]] | None = None) -> tuple[dict[str, list], float, int]:
+    """Return the result, the best wall time of three runs and the peak memory."""
+    wall = math.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        result = run(contents, fusegroups)
+        wall = min(wall, time.perf_counter() - start)
+    tracemalloc.start()
+    run(contents, fusegroups)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, wall, peak
+
+
+def compare(golden: dict[str, list], result: dict[str, list], tolerance: float) -> list[str]:
+    """Return the differences between the golden and the new series."""
+    errors = []
+    for key in sorted(golden.keys() | result.keys()):
+        expected, actual = golden.get(key), result.get(key)
+        if expected is None or actual is None:
+            errors.append(f"{key}: {'missing' if actual is None else 'not in golden'}")
+        elif len(expected) != len(actual):
+            errors.append(f"{key}: length {len(actual)} != {len(expected)}")
+        elif diffs := [i for i, (e, a) in enumerate(zip(expected, actual)) if abs(e - a) > tolerance]:
+            worst = max(abs(expected[i] - actual[i]) for i in diffs)
+            errors.append(f"{key}: {len(diffs)} values differ, first at {diffs[0]} ({actual[diffs[0]]} != {expected[diffs[0]]}), max {worst}")
+    return errors
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare the simulator with the golden results.")
+    parser.add_argument("--update", action="store_true", help="store the current results as golden")
+    parser.add_argument("--tolerance", type=float, default=0, help="allowed absolute difference per value")
+    parser.add_argument("--time-budget", type=float, default=25, help="allowed wall time regression (%%)")
+    parser.add_argument("--memory-budget", type=float, default=25, help="allowed peak memory regression (%%)")
+    parser.add_argument("--no-budget", action="store_true", help="only check the results")
+    parser.add_argument("logs", nargs="*", help="only check these logs")
+    args = parser.parse_args()
+
+    failed = 0
+    logs = {name: contents for name, contents in corpus().items() if not args.logs or name in args.logs}
+    for name, contents in logs.items():
+        path = os.path.join(GOLDEN_DIR, f"{name}.json.gz")
+        result, wall, peak = measure(contents, FUSEGROUPS.get(name))
+        if args.update:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with gzip.open(path, "wt") as f:
+                json.dump({"wall": wall, "peak": peak, "series": result}, f, separators=(",", ":"))
+            print(f"{name}: updated ({wall * 1000:.0f} ms, {peak / 1e6:.1f} MB)")
+            continue
+
+        if not os.path.exists(path):
+            print(f"{name}: no golden result, run with --update")
+            failed += 1
+            continue
+        with gzip.open(path, "rt") as f:
+            golden: dict[str, Any] = json.load(f)
+
+        errors = compare(golden["series"], result, args.tolerance) + lockstep(contents, FUSEGROUPS.get(name)) + replayed(contents, FUSEGROUPS.get(name))
+        if not args.no_budget:
+            if wall > golden["wall"] * (1 + args.time_budget / 100):
+                errors.append(f"wall time {wall * 1000:.0f} ms exceeds {golden['wall'] * 1000:.0f} ms + {args.time_budget}%")
+            if peak > golden["peak"] * (1 + args.memory_budget / 100):
+                errors.append(f"peak memory {peak / 1e6:.1f} MB exceeds {golden['peak'] / 1e6:.1f} MB + {args.memory_budget}%")
+
+        status = "FAIL" if errors else "ok"
+        print(f"{name}: {status} ({wall * 1000:.0f}/{golden['wall'] * 1000:.0f} ms, {peak / 1e6:.1f}/{golden['peak'] / 1e6:.1f} MB)")
+        for error in errors:
+            print(f"    {error}")
+        failed += 1 if errors else 0
+
+    if logs and not args.update:
+        errors = batched(logs)
+        print(f"batch: {'FAIL' if errors else 'ok'} ({len(logs)} logs)")
+        for error in errors:
+            print(f"    {error}")
+        failed += 1 if errors else 0
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
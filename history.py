@@ -0,0 +1,70 @@
+"""History of simulation runs for the loaded logfile."""
+
+from __future__ import annotations
+
+import json
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any
+
+CONST_HISTORY = 10
+
+
+class SimulationRun:
+    """Outputs and parameters of one simulation run.
+
+    The input series are not copied, the run references the lists of the
+    simulator, the outputs are stored as compact arrays. The simulated pack
+    series are only kept when the packs were simulated.
+    """
+
+    def __init__(self, runid: int, parameters: dict[str, Any], time: list[datetime], sim_p1: list[int], sim_home: list[int], sim_level: dict[str, list[int]], pack_level: dict[str, Any] | None = None, pack_power: dict[str, Any] | None = None) -> None:
+        """Initialize the simulation run."""
+        self.runid = runid
+        self.parameters = parameters
+        self.time = time
+        self.sim_p1 = array("i", sim_p1)
+        self.sim_home = array("i", sim_home)
+        self.sim_level = {name: array("h", levels) for name, levels in sim_level.items()}
+        self.pack_level = pack_level
+        self.pack_power = pack_power
+
+    @property
+    def label(self) -> str:
+        p = self.parameters
+        label = f"#{self.runid} {p.get('distribution_mode')} start {p.get('start_power')}W tolerance {p.get('power_tolerance')}W"
+        return label + (" fuse groups" if p.get("fusegroups") else "")
+
+    @staticmethod
+    def key(parameters: dict[str, Any]) -> str:
+        return json.dumps(parameters, sort_keys=True)
+
+
+class RunHistory:
+    """Bounded history of simulation runs, the least recently used run is dropped first."""
+
+    def __init__(self, maxlen: int = CONST_HISTORY) -> None:
+        """Initialize the history."""
+        self.maxlen = maxlen
+        self.runs: OrderedDict[str, SimulationRun] = OrderedDict()
+        self.count = 0
+
+    def get(self, parameters: dict[str, Any]) -> SimulationRun | None:
+        """Return the run with these parameters."""
+        if (run := self.runs.get(key := SimulationRun.key(parameters))) is not None:
+            self.runs.move_to_end(key)
+        return run
+
+    def find(self, runid: int | None) -> SimulationRun | None:
+        """Return the run with this id."""
+        return next((r for r in self.runs.values() if r.runid == runid), None)
+
+    def add(self, parameters: dict[str, Any], **outputs: Any) -> SimulationRun:
+        """Add a run, the outputs are passed to SimulationRun."""
+        self.count += 1
+        run = SimulationRun(self.count, parameters, **outputs)
+        self.runs[SimulationRun.key(parameters)] = run
+        while len(self.runs) > self.maxlen:
+            self.runs.popitem(last=False)
+        return run
@@ -0,0 +1,243 @@
+"""Lockstep simulation of parameter variants, forking only where their decisions diverge."""
+
+from __future__ import annotations
+
+import copy
+import logging
+from datetime import datetime
+from typing import Any
+
+from distribution import Distribution
+from fusegroup import FuseGroup
+from history import RunHistory, SimulationRun
+from simulator import ZendureSimulator
+
+_LOGGER = logging.getLogger(__name__)
+
+def _parameter(name: str) -> property:
+    def get(self: VariantDistribution) -> Any:
+        self.reads.add(name)
+        return self.variant[name]
+
+    def set(self: VariantDistribution, value: Any) -> None:
+        self.variant[name] = value
+
+    return property(get, set)
+
+
+class VariantDistribution(Distribution):
+    """Distribution that records which of its parameters a decision reads."""
+
+    mode = _parameter("mode")
+    start_power = _parameter("start_power")
+    power_tolerance = _parameter("power_tolerance")
+
+    def __init__(self, *args: Any) -> None:
+        """Initialize the distribution."""
+        self.variant: dict[str, Any] = {}
+        self.reads: set[str] = set()
+        super().__init__(*args)
+
+
+class VariantGroup:
+    """Variants that share one simulation state, the first variant drives the distribution."""
+
+    def __init__(self, state: ZendureSimulator, distribution: VariantDistribution, members: list[int]) -> None:
+        """Initialize the group."""
+        self.state = state
+        self.distribution = distribution
+        self.members = members
+
+        # all fuse groups of the devices, their cached limits are part of the state
+        self.fusegroups: list[FuseGroup] = []
+        for d in distribution.devices:
+            stack = [d.fuseGrp.root]
+            while stack:
+                if (grp := stack.pop()) not in self.fusegroups:
+                    self.fusegroups.append(grp)
+                    stack.extend(grp.children)
+
+    def capture(self) -> tuple:
+        """Return the state a distribution update changes."""
+        distribution = self.distribution
+        return (
+            tuple((d.power_setpoint, d.power_time, d.power_limit, tuple(d.fuse_limit), d.fuseKey) for d in distribution.devices),
+            tuple((grp.dirty, tuple(grp.total), tuple(grp.weight), tuple(grp.budget)) for grp in self.fusegroups),
+            tuple(distribution.setpoint_history),
+            distribution.setpoint_sensor.data,
+        )
+
+    def apply(self, state: tuple) -> None:
+        """Restore the state captured before or after a distribution update."""
+        devices, fusegroups, history, setpoint = state
+        for d, (power_setpoint, power_time, power_limit, fuse_limit, fuseKey) in zip(self.distribution.devices, devices):
+            d.power_setpoint = power_setpoint
+            d.power_time = power_time
+            d.power_limit = power_limit
+            d.fuse_limit = list(fuse_limit)
+            d.fuseKey = fuseKey
+        for grp, (dirty, total, weight, budget) in zip(self.fusegroups, fusegroups):
+            grp.dirty = dirty
+            grp.total = list(total)
+            grp.weight = list(weight)
+            grp.budget = list(budget)
+        self.distribution.setpoint_history.clear()
+        self.distribution.setpoint_history.extend(history)
+        self.distribution.setpoint_sensor.data = setpoint
+
+
+class ZendureLockstep:
+    """Simulate parameter variants in lockstep.
+
+    All variants start in one group that shares the devices and the
+    distribution. Every tick the distribution is updated once with the
+    parameters of the first variant, and records which parameters it read. A
+    variant that differs in one of those parameters is replayed from the state
+    before the update. If its decisions differ it forks into a new group with a
+    copy of the state, otherwise it keeps sharing. The input series are never
+    copied.
+    """
+
+    def __init__(self, sim: ZendureSimulator, factory: type[VariantDistribution] = VariantDistribution) -> None:
+        """Initialize the lockstep simulation of a loaded simulator."""
+        self.sim = sim
+        self.factory = factory
+        self.variants: list[dict[str, Any]] = []
+        self.groups: list[VariantGroup] = []
+        self.forks: list[dict[str, Any]] = []
+        self.runs: list[SimulationRun] = []
+        self.shared: dict[int, Any] = {}
+        self.ticks = 0
+        self.replays = 0
+
+    def run(self, variants: list[tuple[str, int, int]], fusegroups: list[dict[str, Any]] | None = None) -> dict[str, Any]:
+        """Simulate the (distribution_mode, start_power, power_tolerance) variants.
+
+        The runs are added to the history of the simulator, the history only
+        keeps the most recent runs, all runs are kept in `runs` in the order of
+        the variants.
+        """
+        sim = self.sim
+        variants = list(dict.fromkeys(variants))
+        if len(sim.time) == 0 or len(variants) == 0:
+            return {}
+
+        self.variants = [{"mode": sim.distribution_mode(m), "start_power": sp, "power_tolerance": tol} for m, sp, tol in variants]
+        self.groups = [self._start(variants[0], fusegroups, list(range(len(variants))))]
+        self.forks = []
+        self.ticks = self.replays = 0
+
+        starttime = sim.time[0]
+        for i, t in enumerate(sim.time):
+            seconds = (t - starttime).total_seconds()
+            for group in list(self.groups):
+                self._step(group, i, t, seconds)
+            starttime = t
+
+        # add the runs to the history of the simulator, and show the first variant
+        runs: dict[int, SimulationRun] = {}
+        for group in self.groups:
+            state = group.state
+            for k in group.members:
+                runs[k] = sim.history.add(
+                    sim.run_parameters(*variants[k], fusegroups),
+                    time=sim.time,
+                    sim_p1=state.sim_p1,
+                    sim_home=state.sim_home,
+                    sim_level={d.name: d.sim_level for d in state.devices.values()},
+                )
+        self.runs = [runs[k] for k in range(len(variants))]
+        sim.restore(self.runs[0])
+        sim.version += 1
+
+        return {
+            "variants": len(variants),
+            "groups": [[variants[k] for k in g.members] for g in self.groups],
+            "forks": self.forks,
+            "ticks": self.ticks,
+            "replays": self.replays,
+            "full_ticks": len(variants) * len(sim.time),
+        }
+
+    def _start(self, variant: tuple[str, int, int], fusegroups: list[dict[str, Any]] | None, members: list[int]) -> VariantGroup:
+        """Create the first group, sharing the input series of the simulator."""
+        sim = self.sim
+        self.shared = {id(v): v for v in (sim.time, sim.p1, sim.homeC, sim.homeZ, sim.solar, sim.offgrid, sim.modes)}
+        for d in sim.devices.values():
+            self.shared.update({id(v): v for v in (d.solar, d.offgrid, d.levels)})
+            for b in d.batteries.values():
+                if b is not None:
+                    self.shared.update({id(b.levels): b.levels, id(b.powers): b.powers})
+
+        state = copy.copy(sim)
+        state.history = RunHistory()
+        state._rollup = None
+        state.run = None
+        state.sim_p1 = []
+        state.sim_home = []
+        state.devices = copy.deepcopy(sim.devices, dict(self.shared))
+        for d in state.devices.values():
+            d.resetSimulation()
+        distribution = state.create_distribution(*variant, fusegroups, factory=self.factory)
+        state.packs = None
+        return VariantGroup(state, distribution, members)
+
+    def _step(self, group: VariantGroup, i: int, t: datetime, seconds: float) -> None:
+        """Advance a group one tick, fork the variants that decide differently."""
+        state, distribution = group.state, group.distribution
+        self.ticks += 1
+        simp1 = state.advance(distribution, state.packs, i, seconds)
+
+        before = group.capture() if len(group.members) > 1 else None
+        distribution.reads = set()
+        distribution.update(simp1, t)
+
+        if before is not None and (reads := set(distribution.reads)):
+            lead = self.variants[group.members[0]]
+            others = [k for k in group.members[1:] if any(self.variants[k][name] != lead[name] for name in reads)]
+            if len(others) > 0:
+                after = group.capture()
+                group.members = [k for k in group.members if k not in others]
+                while len(others) > 0:
+                    # variants with the same values for all parameters the replay read decide the same
+                    variant = self.variants[others[0]]
+                    decided, read = self._replay(group, variant, before, simp1, t)
+                    same = [k for k in others if all(self.variants[k][name] == variant[name] for name in read)]
+                    others = [k for k in others if k not in same]
+                    if decided == after:
+                        group.members.extend(same)
+                    else:
+                        self._fork(group, same, i, t, simp1)
+                distribution.variant = dict(lead)
+                group.apply(after)
+
+        state.sim_p1.append(simp1)
+        state.sim_home.append(sum(d.power_setpoint for d in state.devices.values()))
+
+    def _replay(self, group: VariantGroup, variant: dict[str, Any], before: tuple, simp1: int, t: datetime) -> tuple[tuple, set[str]]:
+        """Update the distribution with the parameters of another variant from the state before the update."""
+        self.replays += 1
+        group.apply(before)
+        distribution = group.distribution
+        distribution.variant = dict(variant)
+        distribution.reads = set()
+        distribution.update(simp1, t)
+        return group.capture(), set(distribution.reads)
+
+    def _fork(self, group: VariantGroup, members: list[int], i: int, t: datetime, simp1: int) -> None:
+        """Copy the state of a group, as left by the replay of the forking variants."""
+        state, distribution = copy.deepcopy((group.state, group.distribution), dict(self.shared))
+        state.sim_p1.append(simp1)
+        state.sim_home.append(sum(d.power_setpoint for d in state.devices.values()))
+        self.groups.append(VariantGroup(state, distribution, members))
+        self.forks.append({"tick": i, "time": t.isoformat(), "variants": [self._label(k) for k in members], "parent": self._label(group.members[0])})
+        _LOGGER.info("Fork at tick %s (%s): %s", i, t, ", ".join(self._label(k) for k in members))
+
+    def _label(self, k: int) -> str:
+        v = self.variants[k]
+        return f"{v['mode'].name} start {v['start_power']}W tolerance {v['power_tolerance']}W"
+
+
+def lockstep(sim: ZendureSimulator, variants: list[tuple[str, int, int]], fusegroups: list[dict[str, Any]] | None = None) -> dict[str, Any]:
+    """Simulate the variants of the loaded logfile in lockstep."""
+    return ZendureLockstep(sim).run(variants, fusegroups)
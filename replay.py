@@ -0,0 +1,180 @@
+"""Asyncio replay of a logfile, driving the distribution like the live P1 meter."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from array import array
+from typing import Any, Awaitable, Callable
+
+from distribution import Distribution
+from simulator import ZendureSimulator
+
+_LOGGER = logging.getLogger(__name__)
+
+TOPIC_REPORT = "/zendure/{}/properties/report"
+TOPIC_P1 = "p1/power"
+
+Callback = Callable[[str, dict[str, Any]], Awaitable[None] | None]
+
+
+class MessageBus:
+    """In-process stand-in for the MQTT broker."""
+
+    def __init__(self) -> None:
+        """Initialize the message bus."""
+        self.subscriptions: list[tuple[list[str], Callback]] = []
+        self.queue: asyncio.Queue[tuple[str, dict[str, Any]]] = asyncio.Queue()
+
+    def subscribe(self, pattern: str, callback: Callback) -> None:
+        """Subscribe to a topic, the MQTT wildcards + and # are supported."""
+        self.subscriptions.append((pattern.split("/"), callback))
+
+    async def publish(self, topic: str, payload: dict[str, Any]) -> None:
+        """Publish a message."""
+        await self.queue.put((topic, payload))
+
+    @staticmethod
+    def match(pattern: list[str], topic: list[str]) -> bool:
+        for i, p in enumerate(pattern):
+            if p == "#":
+                return True
+            if i >= len(topic) or (p != "+" and p != topic[i]):
+                return False
+        return len(pattern) == len(topic)
+
+    async def run(self) -> None:
+        """Dispatch the messages to the subscribers."""
+        while True:
+            topic, payload = await self.queue.get()
+            levels = topic.split("/")
+            try:
+                for pattern, callback in self.subscriptions:
+                    if self.match(pattern, levels) and (result := callback(topic, payload)) is not None:
+                        await result
+            except Exception as err:
+                _LOGGER.error("Error handling %s: %s", topic, err)
+            finally:
+                self.queue.task_done()
+
+
+class LatencyHistogram:
+    """Control loop latency in microseconds."""
+
+    def __init__(self) -> None:
+        self.samples = array("d")
+
+    def add(self, latency_ns: int) -> None:
+        self.samples.append(latency_ns / 1000)
+
+    def percentile(self, pct: float) -> float:
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def buckets(self) -> dict[int, int]:
+        """Return the number of samples per power of two bucket (us)."""
+        result: dict[int, int] = {}
+        for s in self.samples:
+            bucket = 1 << max(0, int(s)).bit_length()
+            result[bucket] = result.get(bucket, 0) + 1
+        return dict(sorted(result.items()))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "count": len(self.samples),
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": max(self.samples, default=0.0),
+            "histogram": self.buckets(),
+        }
+
+
+class ZendureReplay:
+    """Replay a loaded logfile at real time or N x speed.
+
+    The replay acts as the plant: every tick it advances the devices with the
+    current setpoints like ZendureSimulator.advance, publishes a
+    properties/report per device and the resulting P1 power. The distribution
+    is only driven by the bus callbacks, so a replay as fast as possible
+    matches do_simulation.
+    """
+
+    def __init__(self, sim: ZendureSimulator, distribution: Distribution, speed: float = 1.0) -> None:
+        """Initialize the replay, a speed of 0 replays as fast as possible."""
+        self.sim = sim
+        self.distribution = distribution
+        self.speed = speed
+        self.bus = MessageBus()
+        self.latency = LatencyHistogram()
+        self.lag = 0.0
+        self.bus.subscribe(TOPIC_REPORT.format("+"), self._report_received)
+        self.bus.subscribe(TOPIC_P1, self._p1_changed)
+
+    def _report_received(self, topic: str, payload: dict[str, Any]) -> None:
+        if (d := self.sim.devices.get(payload.get("deviceId", ""))) is not None:
+            d.readEntities(payload)
+
+    def _p1_changed(self, topic: str, payload: dict[str, Any]) -> None:
+        p1 = int(self.distribution.p1_factor * float(payload["state"]))
+        self.distribution.update(p1, payload["time"])
+        self.latency.add(time.perf_counter_ns() - payload["ts"])
+        self.sim.sim_p1.append(p1)
+        self.sim.sim_home.append(sum(d.power_setpoint for d in self.sim.devices.values()))
+
+    async def _publish(self) -> None:
+        sim = self.sim
+        sim.run = None
+        sim.sim_p1 = []
+        sim.sim_home = []
+        for d in sim.devices.values():
+            d.resetSimulation()
+
+        start = time.monotonic()
+        prev = sim.time[0]
+        for i, t in enumerate(sim.time):
+            delay = (t - sim.time[0]).total_seconds() / self.speed - (time.monotonic() - start) if self.speed > 0 else 0.0
+            self.lag = max(self.lag, -delay)
+            await asyncio.sleep(max(0.0, delay))
+
+            # advance the plant with the current setpoints, and report the resulting device state
+            simp1 = sim.advance(self.distribution, None, i, (t - prev).total_seconds())
+            for d in self.distribution.devices:
+                home = d.homePower.asInt
+                offgrid = d.offGrid.asInt if d.offGrid is not None else 0
+                await self.bus.publish(TOPIC_REPORT.format(d.deviceid), {
+                    "deviceId": d.deviceid,
+                    "properties": {
+                        # while charging the offgrid output is taken from the grid input as well
+                        "gridInputPower": max(0, -home) + (max(0, offgrid) if home < 0 else 0),
+                        "outputHomePower": max(0, home),
+                        "packInputPower": 0,
+                        "solarInputPower": d.solarPower.asInt,
+                        "gridOffPower": offgrid,
+                    },
+                })
+            await self.bus.publish(TOPIC_P1, {"state": simp1, "time": t, "ts": time.perf_counter_ns()})
+            # the next tick sees the setpoints of this one, a slow control loop shows as lag
+            await self.bus.queue.join()
+            prev = t
+
+    async def run(self) -> dict[str, Any]:
+        """Replay the logfile and return the latency statistics."""
+        if len(self.sim.time) == 0:
+            return {}
+        dispatcher = asyncio.create_task(self.bus.run())
+        try:
+            await self._publish()
+            await self.bus.queue.join()
+        finally:
+            dispatcher.cancel()
+            self.sim.version += 1
+        return {"latency": self.latency.stats(), "lag": self.lag, "events": len(self.sim.time)}
+
+
+def replay(sim: ZendureSimulator, distribution_mode: str, start_power: int, power_tolerance: int, speed: float = 1.0, fusegroups: list[dict[str, Any]] | None = None) -> dict[str, Any]:
+    """Replay the loaded logfile of the simulator."""
+    distribution = sim.create_distribution(distribution_mode, start_power, power_tolerance, fusegroups)
+    return asyncio.run(ZendureReplay(sim, distribution, speed).run())
@@ -0,0 +1,172 @@
+"""Multi-resolution rollups of the simulator time series."""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any
+
+import numpy as np
+
+from transport import EPOCH
+
+CONST_LEVELS = (10, 60, 900)
+CONST_UFUNCS = {"min": np.minimum, "max": np.maximum, "sum": np.add, "pos": np.add}
+
+
+def hold_seconds(epoch: np.ndarray) -> np.ndarray:
+    """Return how long the value of every tick is held, until the next tick, the last tick is not held."""
+    return np.append(np.diff(epoch), 0.0)
+
+
+def tick_energy(values: np.ndarray, seconds: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the positive and negative energy (W*s) of the ticks, summed over the first axis.
+
+    This is the energy convention of the simulator: the value of a tick is held
+    for its hold_seconds, like the graphs show it.
+    """
+    energy = values * seconds
+    return np.where(energy > 0, energy, 0.0).sum(axis=0), np.where(energy < 0, -energy, 0.0).sum(axis=0)
+
+
+class RollupPyramid:
+    """Rollups of time series in buckets of 10s, 1 min and 15 min.
+
+    The series hold integer values (W or %). Every level is built from the level
+    below. A bucket holds the min, max, integral (W*s) and positive integral of
+    each series, the value of a tick is held until the next tick. Appending ticks only recomputes the last bucket of
+    every level.
+    """
+
+    def __init__(self, time: list[datetime] | None = None, series: dict[str, list[int]] | None = None, levels: tuple[int, ...] = CONST_LEVELS) -> None:
+        """Initialize the pyramid."""
+        self.sizes = levels
+        self.epoch = np.zeros(0)
+        self.dt = np.zeros(0)
+        self.values: dict[str, np.ndarray] = {}
+        self.levels: list[dict[str, Any]] = [
+            {"start": np.zeros(0), "first": np.zeros(0, dtype=np.intp), "dur": np.zeros(0), "stats": {}} for _ in levels
+        ]
+        if time:
+            self.extend(time, series or {})
+
+    def extend(self, time: list[datetime], series: dict[str, list[int]]) -> None:
+        """Append ticks, series that are not given are extended with zeros."""
+        if len(time) == 0:
+            return
+        count = len(self.epoch)
+        offset = (time[0] - EPOCH).total_seconds()
+        epoch = offset + np.fromiter(((t - time[0]).total_seconds() for t in time), dtype=np.float64, count=len(time))
+        self.epoch = np.concatenate([self.epoch, epoch])
+        self.dt = hold_seconds(self.epoch)
+        for name in self.values.keys() | series.keys():
+            values = np.asarray(series.get(name, np.zeros(len(time))), dtype=np.int32)
+            self.values[name] = np.concatenate([self.values.get(name, np.zeros(count, dtype=np.int32)), values])
+        self._update(max(0, count - 1), list(self.values))
+
+    def add(self, name: str, values: list[int]) -> None:
+        """Add or replace a series on the existing time axis, like the simulated series."""
+        self.values[name] = np.asarray(values, dtype=np.int32)[: len(self.epoch)]
+        self._update(0, [name], rebucket=False)
+
+    def remove(self, name: str) -> None:
+        """Remove a series."""
+        self.values.pop(name, None)
+        for lvl in self.levels:
+            lvl["stats"].pop(name, None)
+
+    def _source(self, level: int, name: str, first: int) -> dict[str, np.ndarray]:
+        """Return the stats of a series in the level below, from the first index onwards."""
+        if level == 0:
+            values = self.values[name][first:]
+            integral = values * self.dt[first:]
+            return {"min": values, "max": values, "sum": integral, "pos": np.maximum(integral, 0.0)}
+        return {stat: values[first:] for stat, values in self.levels[level - 1]["stats"][name].items()}
+
+    def _update(self, index: int, names: list[str], rebucket: bool = True) -> None:
+        """Recompute the buckets from the source index onwards."""
+        for level, size in enumerate(self.sizes):
+            lvl = self.levels[level]
+            start, dur = (self.epoch, self.dt) if level == 0 else (self.levels[level - 1]["start"], self.levels[level - 1]["dur"])
+
+            # restart at the bucket that contains the index
+            bucket = max(0, int(np.searchsorted(lvl["first"], index, side="right")) - 1) if rebucket else 0
+            first = int(lvl["first"][bucket]) if bucket < len(lvl["first"]) else 0
+            keys = np.floor(start[first:] / size)
+            begin = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1]) if len(keys) > 0 else np.zeros(0, dtype=np.intp)
+
+            def reduce(values: np.ndarray, ufunc: np.ufunc) -> np.ndarray:
+                return ufunc.reduceat(values, begin) if len(begin) > 0 else values[:0]
+
+            if rebucket:
+                lvl["start"] = np.concatenate([lvl["start"][:bucket], keys[begin] * size])
+                lvl["first"] = np.concatenate([lvl["first"][:bucket], begin + first]).astype(np.intp)
+                lvl["dur"] = np.concatenate([lvl["dur"][:bucket], reduce(dur[first:], np.add)])
+            for name in names:
+                old = lvl["stats"].get(name)
+                stats = self._source(level, name, first)
+                lvl["stats"][name] = {
+                    stat: reduce(values, CONST_UFUNCS[stat]) if old is None else np.concatenate([old[stat][:bucket], reduce(values, CONST_UFUNCS[stat])])
+                    for stat, values in stats.items()
+                }
+            index = bucket
+
+    def level_for(self, start: float, end: float, points: int) -> int:
+        """Return the coarsest level with at least the requested number of points in the window, -1 for the ticks."""
+        resolution = (end - start) / max(1, points)
+        for level in range(len(self.sizes) - 1, -1, -1):
+            if self.sizes[level] <= resolution:
+                return level
+        return -1
+
+    def window(self, name: str, start: float | None = None, end: float | None = None, points: int = 2000) -> dict[str, np.ndarray]:
+        """Return the time (epoch seconds), min, max and mean of a series in the window."""
+        start = self.epoch[0] if start is None else start
+        end = self.epoch[-1] if end is None else end
+        if (level := self.level_for(start, end, points)) < 0:
+            lo, hi = np.searchsorted(self.epoch, [start, end], side="left")
+            v = self.values[name][lo : hi + 1]
+            return {"time": self.epoch[lo : hi + 1], "min": v, "max": v, "mean": v}
+
+        lvl = self.levels[level]
+        lo, hi = np.searchsorted(lvl["start"], [start - self.sizes[level], end], side="right")
+        stats = lvl["stats"][name]
+        dur = lvl["dur"][lo:hi]
+        first = lvl["first"][lo:hi]
+        if level > 0:
+            first = self._ticks(level, first)
+        mean = np.divide(stats["sum"][lo:hi], dur, out=self.values[name][first].astype(np.float64), where=dur > 0)
+        return {"time": lvl["start"][lo:hi], "min": stats["min"][lo:hi], "max": stats["max"][lo:hi], "mean": mean}
+
+    def _ticks(self, level: int, first: np.ndarray) -> np.ndarray:
+        """Return the tick index of the first tick of buckets."""
+        for below in range(level - 1, -1, -1):
+            first = self.levels[below]["first"][first]
+        return first
+
+    def energy(self, name: str, start: float | None = None, end: float | None = None) -> tuple[float, float]:
+        """Return the positive and negative energy (Wh) of a series in the window."""
+        start = self.epoch[0] if start is None else start
+        end = self.epoch[-1] + 1 if end is None else end
+        pos, total = self._energy(name, len(self.sizes) - 1, start, end)
+        return pos / 3600, (pos - total) / 3600
+
+    def _energy(self, name: str, level: int, start: float, end: float) -> tuple[float, float]:
+        """Sum the complete buckets of the level, and the edges from the level below."""
+        if level < 0:
+            lo, hi = np.searchsorted(self.epoch, [start, end], side="left")
+            pos, neg = tick_energy(self.values[name][lo:hi], self.dt[lo:hi])
+            return float(pos), float(pos - neg)
+
+        size = self.sizes[level]
+        first, last = np.ceil(start / size) * size, np.floor(end / size) * size
+        if first >= last:
+            return self._energy(name, level - 1, start, end)
+        lvl = self.levels[level]
+        lo, hi = np.searchsorted(lvl["start"], [first, last], side="left")
+        stats = lvl["stats"][name]
+        pos, total = float(stats["pos"][lo:hi].sum()), float(stats["sum"][lo:hi].sum())
+        for a, b in ((start, first), (last, end)):
+            if a < b:
+                p, t = self._energy(name, level - 1, a, b)
+                pos, total = pos + p, total + t
+        return pos, total
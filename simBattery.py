@@ -9,7 +9,7 @@ from simEntity import simEntity
 class ZendureBattery:
     """Representation of a Zendure battery."""
 
-    def __init__(self, parent: str, device_sn: str) -> None:
+    def __init__(self, parent: str, device_sn: str, count: int = 0) -> None:
         """Initialize the Zendure battery."""
         self.kWh = 0.0
         match device_sn[0]:
@@ -33,6 +33,8 @@ class ZendureBattery:
                 model = "Unknown"
                 self.kWh = 0.0
 
+        self.sn = device_sn
+        self.model = model
         self.lastseen = datetime.min
 
         # Create the battery entities."""
@@ -45,7 +47,11 @@ class ZendureBattery:
         self.batcur = simEntity(self, "batcur")
         self.maxVol = simEntity(self, "maxVol")
         self.minVol = simEntity(self, "minVol")
-        
+
+        # recorded series, aligned with the simulator time axis
+        self.levels: list[int] = [0] * count
+        self.powers: list[int] = [0] * count
+
     def entityRead(self, payload: dict) -> None:
         """Handle incoming MQTT message for the battery."""
         for key, value in payload.items():
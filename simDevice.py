@@ -27,6 +27,8 @@ class ZendureDevice:
         self.kWh = 4.0
         self.limit = [-1200, 1200]
         self.level = 0
+        self.fuse_limit = [0, 0]
+        self.fuseKey: tuple | None = None
         self.fuseGrp: FuseGroup = FuseGroup(self.name, 3200, -3200, devices=[self])  # Default empty fuse group
         self.values = [0, 0, 0, 0]
         self.power_setpoint = 0
@@ -73,7 +75,7 @@ class ZendureDevice:
                     continue
 
                 if (bat := self.batteries.get(sn, None)) is None:
-                    self.batteries[sn] = ZendureBattery(self.name, sn)
+                    self.batteries[sn] = ZendureBattery(self.name, sn, len(self.levels))
                     self.kWh = sum(0 if b is None else b.kWh for b in self.batteries.values())
                     self.batteryUpdate()
                 elif bat and b:
@@ -120,6 +122,20 @@ class ZendureDevice:
         except Exception:
             _LOGGER.error(f"SetLimits error {self.name} {charge} {discharge}!")
 
+    def resetSimulation(self) -> None:
+        """Clear the state of a previous simulation run."""
+        self.sim_level = []
+        self.power_setpoint = 0
+        self.power_time = datetime.min
+        self.power_limit = 0
+
+    def fuseUpdate(self) -> None:
+        """Mark the fuse group dirty if the state used for its limits changed."""
+        key = (self.homePower.asInt != 0, self.level, self.limit[0], self.limit[1])
+        if key != self.fuseKey:
+            self.fuseKey = key
+            self.fuseGrp.mark_dirty()
+
     def distribute(self, power: int, time: datetime) -> int:
         """Set charge/discharge power"""
         # if self.power_time != datetime.min and (delta := (self.power_time - time).total_seconds())> 0:
@@ -0,0 +1,89 @@
+"""Per-pack battery simulation for Zendure devices."""
+
+from __future__ import annotations
+
+import numpy as np
+
+from simDevice import ZendureDevice
+
+
+class ZendurePacks:
+    """Simulate the SOC and power of all battery packs as flat arrays.
+
+    The packs of all devices are stored side by side, `dev` maps every pack to
+    the index of its device. The power of a device is divided over its packs
+    according to the energy each pack can still deliver or absorb, so packs with
+    a different SOC converge over time. The SOC of a pack stays within the
+    minimum and maximum SOC of its device, and its power within its share of
+    the device limits. A run only simulates the packs when asked for, it adds
+    a few ufuncs to every tick.
+    """
+
+    def __init__(self, devices: list[ZendureDevice], count: int) -> None:
+        """Initialize the pack arrays."""
+        self.devices = devices
+        self.names: list[str] = []
+        dev: list[int] = []
+        kwh: list[float] = []
+        levels: list[list[int]] = []
+        powers: list[list[int]] = []
+        for i, d in enumerate(devices):
+            for b in d.batteries.values():
+                if b is None or b.kWh == 0:
+                    continue
+                self.names.append(f"{d.name} {b.sn}")
+                dev.append(i)
+                kwh.append(b.kWh)
+                levels.append(b.levels)
+                powers.append(b.powers)
+
+        size = len(dev)
+        self.dev = np.array(dev, dtype=np.intp)
+        self.kWh = np.array(kwh, dtype=np.float64)
+        self.minSoc = np.array([devices[i].minSoc.asNumber for i in dev], dtype=np.float64)
+        self.socSet = np.array([devices[i].socSet.asNumber for i in dev], dtype=np.float64)
+        self.scale = 1 / (36000 * self.kWh)
+
+        # the charge (row 0) and discharge (row 1) limit of a pack is its share in the kWh of the device
+        share = self.kWh / np.bincount(self.dev, self.kWh, len(devices)).take(self.dev) if size > 0 else self.kWh
+        self.limit = np.array([[devices[i].limit[k] for i in dev] for k in (0, 1)], dtype=np.float64).reshape(2, size) * share
+        self.soc = np.zeros(size, dtype=np.float64)
+        self.power = np.zeros(size, dtype=np.float64)
+        self.device_power = np.zeros(len(devices), dtype=np.float64)
+
+        # recorded and simulated series, one row per tick
+        self.levels = np.array(levels, dtype=np.int16).T.reshape(count, size) if size > 0 else np.zeros((count, 0), dtype=np.int16)
+        self.powers = np.array(powers, dtype=np.int32).T.reshape(count, size) if size > 0 else np.zeros((count, 0), dtype=np.int32)
+        self.sim_level = np.zeros((count, size), dtype=np.float32)
+        self.sim_power = np.zeros((count, size), dtype=np.float32)
+
+    def start(self, index: int) -> None:
+        """Initialize the pack SOC from the recorded values, like the device it is clamped from the first step on."""
+        for i, d in enumerate(self.devices):
+            packs = self.dev == i
+            level = d.levels[d.startindex]
+            recorded = self.levels[d.startindex, packs] if d.startindex >= 0 else np.full(packs.sum(), level)
+            self.soc[packs] = np.where(recorded > 0, recorded, level)
+        self.power[:] = 0
+        self.sim_level[index] = self.soc
+        self.sim_power[index] = 0
+
+    def step(self, index: int, seconds: float) -> None:
+        """Divide the device_power over the packs and advance the SOC."""
+        if len(self.dev) == 0:
+            return
+        # use in-place ufuncs, this runs every tick
+        power = self.device_power.take(self.dev)
+        avail = np.where(power > 0, self.soc - self.minSoc, self.socSet - self.soc)
+        np.maximum(avail, 0, out=avail)
+        avail *= self.kWh
+        total = np.bincount(self.dev, avail, len(self.devices)).take(self.dev)
+        total[total == 0] = np.inf
+        power *= avail
+        power /= total
+        np.clip(power, self.limit[0], self.limit[1], out=power)
+        self.power = power
+        self.soc -= power * (seconds * self.scale)
+        np.clip(self.soc, self.minSoc, self.socSet, out=self.soc)
+        self.sim_level[index] = self.soc
+        self.sim_power[index] = power
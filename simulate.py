@@ -0,0 +1,109 @@
+"""
+Run a simulation from the command line, without the Dash UI.
+"""
+
+import argparse
+import json
+import logging
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+from fusegroup import check_fusegroups
+from rollup import hold_seconds, tick_energy
+from simulator import ZendureSimulator
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Simulate the Zendure power distribution for a logfile.")
+    parser.add_argument("logfile", help="Home Assistant debug log (.log), or a table of P1 and device traces (.csv, .parquet)")
+    parser.add_argument("--mode", default="Neutral", choices=["Neutral", "Max Solar", "Min Buying"])
+    parser.add_argument("--start-power", type=int, default=50)
+    parser.add_argument("--power-tolerance", type=int, default=10)
+    parser.add_argument("--fusegroups", help="JSON file with the fuse group configuration")
+    parser.add_argument("--packs", action="store_true", help="also simulate the SOC of the individual battery packs")
+    parser.add_argument("--variant", action="append", default=[], metavar="MODE,START,TOLERANCE",
+                        help="simulate parameter variants in lockstep, can be repeated")
+    parser.add_argument("--replay", type=float, metavar="SPEED",
+                        help="replay the logfile over the message bus at SPEED x real time (0 is as fast as possible) and show the control loop latency")
+    parser.add_argument("--checkpoint", help="write a snapshot of the simulation to this file while it runs")
+    parser.add_argument("--checkpoint-every", type=int, default=100000, help="ticks between snapshots")
+    parser.add_argument("--resume", action="store_true", help="continue from the checkpoint if it exists")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fusegroups = None
+    if args.fusegroups:
+        try:
+            with open(args.fusegroups) as f:
+                fusegroups = json.load(f)
+            check_fusegroups(fusegroups)
+        except ValueError as e:
+            parser.error(f"{args.fusegroups}: {e}")
+
+    if args.checkpoint_every < 1:
+        parser.error("--checkpoint-every must be at least 1")
+
+    if args.resume and args.checkpoint and os.path.exists(args.checkpoint):
+        from snapshot import read_snapshot
+
+        sim = read_snapshot(args.checkpoint)
+        # a checkpoint only continues the run it was written for
+        if os.path.abspath(sim.filename) != os.path.abspath(args.logfile):
+            parser.error(f"{args.checkpoint} is a checkpoint of {sim.filename}, not of {args.logfile}")
+        if sim.parameters != sim.run_parameters(args.mode, args.start_power, args.power_tolerance, fusegroups) or (sim.packs is not None) != args.packs:
+            parser.error(f"{args.checkpoint} was written with other parameters: {json.dumps(sim.parameters)}{' with packs' if sim.packs is not None else ''}")
+    else:
+        sim = ZendureSimulator()
+        sim.load_file(args.logfile)
+
+    if args.variant:
+        from lockstep import ZendureLockstep
+
+        variants = []
+        for v in args.variant:
+            mode, start_power, power_tolerance = v.rsplit(",", 2)
+            variants.append((mode, int(start_power), int(power_tolerance)))
+        lockstep = ZendureLockstep(sim)
+        report = lockstep.run(variants, fusegroups)
+        report["groups"] = len(report["groups"])
+        report["runs"] = [{"parameters": run.label, **grid_energy(sim, run.sim_p1)} for run in lockstep.runs]
+        print(json.dumps(report, indent=2))
+        return
+
+    if args.replay is not None:
+        from replay import replay
+
+        report = replay(sim, args.mode, args.start_power, args.power_tolerance, args.replay, fusegroups)
+        print(json.dumps({**report, **grid_energy(sim, sim.sim_p1)}, indent=2))
+        return
+
+    if args.checkpoint:
+        from snapshot import write_snapshot
+
+        if sim.distribution is None and sim.index == 0:
+            sim.start_simulation(args.mode, args.start_power, args.power_tolerance, fusegroups, args.packs)
+        while not sim.continue_simulation(args.checkpoint_every):
+            write_snapshot(sim, args.checkpoint)
+        write_snapshot(sim, args.checkpoint)
+    else:
+        sim.do_simulation({}, args.mode, args.start_power, args.power_tolerance, fusegroups, args.packs)
+    result = {
+        "ticks": len(sim.time),
+        "devices": {d.name: d.sim_level[-1] if d.sim_level else None for d in sim.devices.values()},
+        **grid_energy(sim, sim.sim_p1),
+    }
+    if sim.run is not None and sim.run.pack_level:
+        result["packs"] = {name: round(float(levels[-1]), 1) for name, levels in sim.run.pack_level.items()}
+    print(json.dumps(result, indent=2))
+
+
+def grid_energy(sim: ZendureSimulator, sim_p1: Sequence[int]) -> dict[str, float]:
+    """Return the grid energy in kWh like the energy KPI of the app, sim_p1 starts with the initial value twice."""
+    epoch = np.array(sim.time, dtype="datetime64[us]").astype(np.int64) / 1e6
+    imported, exported = tick_energy(np.asarray(sim_p1[1:], dtype=np.float64), hold_seconds(epoch))
+    return {"import_kwh": round(float(imported) / 3600000, 3), "export_kwh": round(float(exported) / 3600000, 3)}
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,29 @@
+from __future__ import annotations
+
 import base64
 from datetime import datetime
-from importlib.metadata import distribution
 import json
 import logging
 import traceback
-from typing import Any
+from typing import TYPE_CHECKING, Any
 from const import ManagerMode
 from distribution import Distribution, DistributionMode
+from fusegroup import FuseGroup, load_fusegroups
+from history import RunHistory, SimulationRun
 from simDevice import ZendureDevice
 
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from rollup import RollupPyramid
+    from simPacks import ZendurePacks
+
 _LOGGER = logging.getLogger(__name__)
 
 
 class ZendureSimulator:
     def __init__(self):
+        self.version = 0
         self.reset()
 
     def reset(self) -> None:
@@ -27,12 +37,31 @@ class ZendureSimulator:
         self.modes = []
         self.sim_home = []
         self.sim_p1 = []
+        self.fusegroups: list[FuseGroup] = []
+        self.packs: ZendurePacks | None = None
+        self._rollup: RollupPyramid | None = None
+        self._rollup_version = -1
+        self.filename = ""
+        self.parameters: dict[str, Any] = {}
+        self.history = RunHistory()
+        self.run: SimulationRun | None = None
+        self.distribution: Distribution | None = None
+        self.index = 0
 
     def load_logfile(self, filename: str, contents: str) -> dict[str, Any]:
-        """Load simulation data from a logfile."""
+        """Load simulation data from an uploaded logfile."""
         content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
+        return self.load_log(filename, base64.b64decode(content_string))
+
+    def load_file(self, path: str) -> dict[str, Any]:
+        """Load simulation data from a logfile on disk."""
+        with open(path, "rb") as f:
+            return self.load_log(path, f.read())
+
+    def load_log(self, filename: str, decoded: bytes) -> dict[str, Any]:
+        """Load simulation data from the logfile contents."""
         self.reset()
+        self.filename = filename
         def add(newP1: int) -> None:
             # update time series
             try:
@@ -49,6 +78,10 @@ class ZendureSimulator:
                 if d.startindex == -1 and d.electricLevel.asInt > 0:
                     d.startindex = len(self.time)
                 d.levels.append(d.electricLevel.asInt)
+                for b in d.batteries.values():
+                    if b is not None:
+                        b.levels.append(b.socLevel.asInt)
+                        b.powers.append(b.power.asInt)
                 home_total += d.homePower.asInt
                 solar_total += d.solarPower.asInt
                 offgrid_total += d.offGrid.asInt
@@ -89,73 +122,201 @@ class ZendureSimulator:
                         mode = ManagerMode(int(operation)) if operation.isnumeric() else ManagerMode[operation.split(".")[-1]]
                         self.modes.append((mode.value, len(self.time)))
 
+            elif filename.endswith(('.csv', '.parquet')):
+                from tabular import load_table  # pyarrow is only needed for tables
+
+                load_table(self, filename, decoded)
+
         except Exception as e:
             _LOGGER.error("Error loading logfile: %s", e)
             _LOGGER.error(traceback.format_exc())
 
-        return { }
-
+        self.version += 1
+        return {"version": self.version}
 
-    def do_simulation(self, data: dict[str, Any], distribution_mode: str, start_power: int, power_tolerance: int) -> dict[str, Any]:
-        """Load simulation data from a logfile."""
 
-        if len(self.time) == 0:
-            return data
-
-        self.sim_home = []
-        self.sim_p1 = []
+    @staticmethod
+    def run_parameters(distribution_mode: str, start_power: int, power_tolerance: int, fusegroups: list[dict[str, Any]] | None = None) -> dict[str, Any]:
+        return {"distribution_mode": distribution_mode, "start_power": start_power, "power_tolerance": power_tolerance, "fusegroups": fusegroups or []}
 
+    @staticmethod
+    def distribution_mode(distribution_mode: str) -> DistributionMode:
         match distribution_mode:
             case "Max Solar":
-                mode = DistributionMode.MAXSOLAR
+                return DistributionMode.MAXSOLAR
             case "Min Buying":
-                mode = DistributionMode.MINBUYING
+                return DistributionMode.MINBUYING
             case _:
-                mode = DistributionMode.NEUTRAL
+                return DistributionMode.NEUTRAL
 
-        distribution = Distribution("", mode, start_power, power_tolerance)
+    def create_distribution(self, distribution_mode: str, start_power: int, power_tolerance: int, fusegroups: list[dict[str, Any]] | None = None, factory: type[Distribution] = Distribution) -> Distribution:
+        """Create the distribution for the loaded devices."""
+        self.fusegroups = load_fusegroups(fusegroups or [], self.devices)
+        self.parameters = self.run_parameters(distribution_mode, start_power, power_tolerance, fusegroups)
+
+        distribution = factory("", self.distribution_mode(distribution_mode), start_power, power_tolerance)
         distribution.set_operation(ManagerMode.MATCHING)
         distribution.devices = list(self.devices.values())
+        return distribution
+
+    def do_simulation(self, data: dict[str, Any], distribution_mode: str, start_power: int, power_tolerance: int, fusegroups: list[dict[str, Any]] | None = None, packs: bool = False) -> dict[str, Any]:
+        """Load simulation data from a logfile, the battery packs are only simulated when asked for."""
+
+        if len(self.time) == 0:
+            return data
+
+        # a previous run with the same parameters is served from the history
+        run = self.history.get(self.run_parameters(distribution_mode, start_power, power_tolerance, fusegroups))
+        if run is not None and (not packs or run.pack_level is not None):
+            self.restore(run)
+            self.version += 1
+            return {**(data or {}), "version": self.version}
 
-        starttime = self.time[0]
-        for i, t in enumerate(self.time):
-            simhome = 0
-            if i == 0:
-                simhome = self.homeZ[0]
-                simp1 = self.p1[0]
-                self.sim_home.append(self.homeZ[0])
-                self.sim_p1.append(self.p1[0])
-                for d in self.devices.values():
-                    d.availableKwh.update_value(d.kWh * (d.levels[d.startindex] - d.minSoc.asNumber) / 100)
-                    avail_max = d.kWh * (d.socSet.asNumber - d.minSoc.asNumber) / 100
-                    d.level = round(100 * d.availableKwh.asNumber / avail_max)
-                    d.homePower.update_value(self.homeZ[d.startindex])
-                    d.solarPower.update_value(d.solar[d.startindex])
-                    d.offGrid.update_value(d.offgrid[d.startindex])
-                    d.sim_level.append(d.levels[d.startindex])
-            else:
-                timeBetweenUpdates = (t - starttime).total_seconds()
-                for d in self.devices.values():
-                    # Update the totals
-                    d.solarPower.update_value(d.solar[i])
-                    d.offGrid.update_value(d.offgrid[i])
-                    simhome += d.power_setpoint
-                    d.homePower.update_value(d.power_setpoint)
-
-                    # update the running values
-                    battery = d.homePower.asInt - d.solarPower.asInt + d.offGrid.asInt
-                    avail = d.availableKwh.asNumber - (battery / 3600000) * timeBetweenUpdates
-                    avail_max = d.kWh * (d.socSet.asNumber - d.minSoc.asNumber) / 100
-                    avail = max(0, min(avail, avail_max))
-                    d.availableKwh.update_value(avail)
-                    d.level = round(100 * d.availableKwh.asNumber / avail_max)
-                    d.sim_level.append(round(100 * avail / d.kWh + d.minSoc.asNumber))
-
-                simp1 = self.homeC[i] - simhome 
+        self.start_simulation(distribution_mode, start_power, power_tolerance, fusegroups, packs)
+        self.continue_simulation()
+        return {**(data or {}), "version": self.version}
 
+    def start_simulation(self, distribution_mode: str, start_power: int, power_tolerance: int, fusegroups: list[dict[str, Any]] | None = None, packs: bool = False, factory: type[Distribution] = Distribution) -> None:
+        """Prepare a simulation run, the ticks are simulated by continue_simulation."""
+        self.distribution = self.create_distribution(distribution_mode, start_power, power_tolerance, fusegroups, factory)
+        self.sim_home = []
+        self.sim_p1 = []
+        for d in self.devices.values():
+            d.resetSimulation()
+        self.packs = None
+        if packs:
+            from simPacks import ZendurePacks  # numpy is only needed for the packs
+
+            self.packs = ZendurePacks(self.distribution.devices, len(self.time))
+        self.index = 0
+
+    def continue_simulation(self, count: int | None = None) -> bool:
+        """Simulate the next ticks of the run, return True when the run is complete."""
+        if (distribution := self.distribution) is None:
+            return self.index >= len(self.time)
+        packs = self.packs
+
+        stop = len(self.time) if count is None else min(len(self.time), self.index + count)
+        starttime = self.time[max(0, self.index - 1)]
+        for i in range(self.index, stop):
+            t = self.time[i]
+            simp1 = self.advance(distribution, packs, i, (t - starttime).total_seconds())
             distribution.update(simp1, t)
             self.sim_p1.append(simp1)
             self.sim_home.append(sum(d.power_setpoint for d in self.devices.values()))
             starttime = t
+        self.index = stop
+        if stop < len(self.time):
+            return False
+
+        self.distribution = None
+        self.run = self.history.add(
+            self.parameters,
+            time=self.time,
+            sim_p1=self.sim_p1,
+            sim_home=self.sim_home,
+            sim_level={d.name: d.sim_level for d in self.devices.values()},
+            pack_level=dict(zip(packs.names, packs.sim_level.T.copy())) if packs is not None else None,
+            pack_power=dict(zip(packs.names, packs.sim_power.T.copy())) if packs is not None else None,
+        )
+        self.version += 1
+        return True
+
+    def advance(self, distribution: Distribution, packs: ZendurePacks | None, i: int, timeBetweenUpdates: float) -> int:
+        """Advance the devices and packs to tick i with the current setpoints, return the simulated P1."""
+        if i == 0:
+            self.sim_home.append(self.homeZ[0])
+            self.sim_p1.append(self.p1[0])
+            for d in self.devices.values():
+                d.availableKwh.update_value(d.kWh * (d.levels[d.startindex] - d.minSoc.asNumber) / 100)
+                avail_max = d.kWh * (d.socSet.asNumber - d.minSoc.asNumber) / 100
+                d.level = round(100 * d.availableKwh.asNumber / avail_max)
+                d.homePower.update_value(self.homeZ[d.startindex])
+                d.solarPower.update_value(d.solar[d.startindex])
+                d.offGrid.update_value(d.offgrid[d.startindex])
+                d.sim_level.append(d.levels[d.startindex])
+            if packs is not None:
+                packs.start(0)
+            return self.p1[0]
+
+        simhome = 0
+        for j, d in enumerate(distribution.devices):
+            # Update the totals
+            d.solarPower.update_value(d.solar[i])
+            d.offGrid.update_value(d.offgrid[i])
+            simhome += d.power_setpoint
+            d.homePower.update_value(d.power_setpoint)
+
+            # update the running values
+            battery = d.homePower.asInt - d.solarPower.asInt + d.offGrid.asInt
+            if packs is not None:
+                packs.device_power[j] = battery
+            avail = d.availableKwh.asNumber - (battery / 3600000) * timeBetweenUpdates
+            avail_max = d.kWh * (d.socSet.asNumber - d.minSoc.asNumber) / 100
+            avail = max(0, min(avail, avail_max))
+            d.availableKwh.update_value(avail)
+            d.level = round(100 * d.availableKwh.asNumber / avail_max)
+            d.sim_level.append(round(100 * avail / d.kWh + d.minSoc.asNumber))
+        if packs is not None:
+            packs.step(i, timeBetweenUpdates)
+
+        return self.homeC[i] - simhome
+
+    def restore(self, run: SimulationRun) -> None:
+        """Show the outputs of a previous run."""
+        self.run = run
+        self.parameters = run.parameters
+        self.sim_p1 = run.sim_p1.tolist()
+        self.sim_home = run.sim_home.tolist()
+        for d in self.devices.values():
+            d.sim_level = run.sim_level[d.name].tolist() if d.name in run.sim_level else []
+        self.packs = None
+
+    @property
+    def rollup(self) -> RollupPyramid | None:
+        """Rollups of the series, built when a graph or KPI first needs them and updated once per version."""
+        if len(self.time) == 0:
+            return None
+        if self._rollup is None:
+            self.build_rollup()
+        if self._rollup_version != self.version:
+            self._rollup_version = self.version
+            self.update_rollup()
+        return self._rollup
+
+    def build_rollup(self) -> None:
+        """Build the rollups of the input series."""
+        from rollup import RollupPyramid  # numpy is only needed once a logfile is loaded
+
+        series = {"p1": self.p1, "homeC": self.homeC, "homeZ": self.homeZ, "solar": self.solar, "offgrid": self.offgrid}
+        series.update({f"level/{d.name}": d.levels for d in self.devices.values()})
+        self._rollup = RollupPyramid(self.time, series)
+
+    def update_rollup(self) -> None:
+        """Add the simulated series to the rollups, drop the series of runs that left the history."""
+        if (rollup := self._rollup) is None:
+            return
+        self._rollup_outputs("", self.sim_p1, self.sim_home, {d.name: d.sim_level for d in self.devices.values()})
+        runs = {f"run{run.runid}/" for run in self.history.runs.values()}
+        for name in [n for n in rollup.values if n.startswith("run") and n[: n.find("/") + 1] not in runs]:
+            rollup.remove(name)
+
+    def rollup_run(self, run: SimulationRun) -> str:
+        """Add the outputs of a run in the history to the rollups, return the prefix of its series."""
+        prefix = f"run{run.runid}/"
+        if (rollup := self.rollup) is not None and f"{prefix}sim_p1" not in rollup.values:
+            self._rollup_outputs(prefix, run.sim_p1, run.sim_home, run.sim_level)
+        return prefix
 
-        return data
\ No newline at end of file
+    def _rollup_outputs(self, prefix: str, sim_p1: Sequence[int], sim_home: Sequence[int], sim_level: dict[str, Sequence[int]]) -> None:
+        count = len(self.time)
+        outputs = {"sim_p1": sim_p1, "sim_home": sim_home}
+        outputs.update({f"sim_level/{name}": levels for name, levels in sim_level.items()})
+        for name, values in outputs.items():
+            # the first tick is in sim_p1 and sim_home twice
+            if len(values) == count + 1:
+                values = values[1:]
+            if len(values) == count:
+                self._rollup.add(prefix + name, values)
+            elif prefix + name in self._rollup.values:
+                self._rollup.remove(prefix + name)
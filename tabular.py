@@ -0,0 +1,109 @@
+"""Columnar import of P1 and device traces from CSV or Parquet."""
+
+from __future__ import annotations
+
+import io
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from simDevice import ZendureDevice
+
+if TYPE_CHECKING:
+    from simulator import ZendureSimulator
+
+# per device columns are named <deviceId>.<field>
+CONST_SERIES = ("solar", "offgrid", "soc", "home")
+CONST_SETTINGS = ("kwh", "charge_limit", "discharge_limit", "min_soc", "max_soc")
+
+
+def read_table(filename: str, contents: bytes) -> pa.Table:
+    """Read a CSV or Parquet file, sorted on the time column."""
+    source = pa.BufferReader(contents)
+    table = pq.read_table(source) if filename.endswith(".parquet") else pacsv.read_csv(io.BytesIO(contents))
+    if "time" not in table.column_names or "p1" not in table.column_names:
+        raise ValueError(f"{filename} needs a time and a p1 column")
+    return table.sort_by("time")
+
+
+def timestamps(column: pa.ChunkedArray) -> list:
+    """Return the time column as naive datetimes, numbers are epoch seconds."""
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        times = (column.to_numpy() * 1e6).astype("datetime64[us]")
+    else:
+        if not pa.types.is_timestamp(column.type):
+            column = pc.cast(column, pa.timestamp("us"))
+        times = column.to_numpy().astype("datetime64[us]")
+    return times.tolist()
+
+
+def series(table: pa.Table, name: str) -> np.ndarray:
+    """Return a column as integers, missing values hold the previous value."""
+    if name not in table.column_names:
+        return np.zeros(table.num_rows, dtype=np.int64)
+    column = pc.fill_null(pc.fill_null_forward(table[name]), 0)
+    return np.rint(column.to_numpy().astype(np.float64)).astype(np.int64)
+
+
+def setting(table: pa.Table, name: str) -> float | None:
+    """Return the last value of a column."""
+    if name not in table.column_names or (values := table[name].drop_null()).length() == 0:
+        return None
+    return float(values[-1].as_py())
+
+
+def load_table(sim: ZendureSimulator, filename: str, contents: bytes) -> None:
+    """Fill the series and devices of a reset simulator from a table.
+
+    The table has a time and a p1 column, and per device the columns
+    <deviceId>.solar, .offgrid, .soc and .home (output to the house) as series
+    and .kwh, .charge_limit, .discharge_limit, .min_soc and .max_soc, of which
+    the last value is used.
+    """
+    table = read_table(filename, contents)
+    count = table.num_rows
+    sim.time = timestamps(table["time"])
+    p1 = series(table, "p1")
+
+    names = dict.fromkeys(
+        prefix for prefix, _, field in (c.rpartition(".") for c in table.column_names) if prefix and field in CONST_SERIES + CONST_SETTINGS
+    )
+    home = np.zeros(count, dtype=np.int64)
+    solar = np.zeros(count, dtype=np.int64)
+    offgrid = np.zeros(count, dtype=np.int64)
+    for name in names:
+        d = ZendureDevice(name, 0)
+        d_solar, d_offgrid, d_levels, d_home = (series(table, f"{name}.{field}") for field in CONST_SERIES)
+        d.solar = d_solar.tolist()
+        d.offgrid = d_offgrid.tolist()
+        d.levels = d_levels.tolist()
+        d.startindex = int(np.argmax(d_levels > 0)) if (d_levels > 0).any() else -1
+        home += d_home
+        solar += d_solar
+        offgrid += d_offgrid
+
+        # the entities hold the last values, like after parsing a logfile
+        if count > 0:
+            d.electricLevel.update_value(d.levels[-1])
+            d.solarPower.update_value(d.solar[-1])
+            d.offGrid.update_value(d.offgrid[-1])
+            d.homePower.update_value(int(d_home[-1]))
+        if (kwh := setting(table, f"{name}.kwh")) is not None:
+            d.kWh = kwh
+        charge, discharge = setting(table, f"{name}.charge_limit"), setting(table, f"{name}.discharge_limit")
+        if charge is not None or discharge is not None:
+            d.setLimits(-int(abs(charge)) if charge is not None else d.limit[0], int(discharge) if discharge is not None else d.limit[1])
+        for entity, field in ((d.minSoc, "min_soc"), (d.socSet, "max_soc")):
+            if (pct := setting(table, f"{name}.{field}")) is not None:
+                entity.update_value(pct / entity.factor)
+        sim.devices[name] = d
+
+    sim.p1 = p1.tolist()
+    sim.homeZ = home.tolist()
+    sim.homeC = (home + p1).tolist()
+    sim.solar = solar.tolist()
+    sim.offgrid = offgrid.tolist()
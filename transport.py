@@ -0,0 +1,29 @@
+"""Compact array transport for the Dash figures."""
+
+from __future__ import annotations
+
+import base64
+from datetime import datetime
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def compact(values: list[int] | np.ndarray) -> np.ndarray:
+    """Return the values in the smallest dtype, Plotly serialises numpy arrays as base64 typed arrays."""
+    arr = np.asarray(values)
+    if arr.size == 0 or arr.dtype.kind not in "iub":
+        return arr.astype(np.float32) if arr.dtype.kind == "f" else arr
+    lo, hi = int(arr.min()), int(arr.max())
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return arr.astype(dtype)
+    return arr.astype(np.int64)
+
+
+def encode(values: np.ndarray) -> dict[str, str]:
+    """Encode an array as a Plotly.js typed array spec, for data outside a figure."""
+    arr = np.ascontiguousarray(values)
+    return {"dtype": arr.dtype.str[1:], "bdata": base64.b64encode(arr.astype(arr.dtype.newbyteorder("<")).tobytes()).decode("ascii")}